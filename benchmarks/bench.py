@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""Benchmarks for DFM primitives.
+
+Run one set of benchmarks on k ranks::
+
+    mpirun -np 4 python benchmarks/bench.py -o bench-4.json
+
+Or sweep over rank counts (this launches mpirun for each)::
+
+    python benchmarks/bench.py --procs 1,2,4 -o bench.json
+
+Every combination of operation, element kind ("obj": lists
+of Python floats, "array": numpy arrays), element count and
+element size (floats per element) is timed.  Each result records:
+
+    time:  best of `--reps` runs (s), using the slowest rank
+    bytes: total bytes sent by all ranks (from a traced run)
+    rss:   peak resident set size during the operation (MiB),
+           on the rank where it grew most
+    rss_delta: that peak, minus the rank's RSS at the start
+           of the operation (MiB)
+
+On Linux, the peak is reset before every run (/proc/self/clear_refs).
+Elsewhere, the lifetime peak (ru_maxrss) is used, so rss_delta
+is only non-zero when an operation raises the lifetime peak.
+
+Counts are totals (strong scaling), or per-rank with --weak.
+Pass --baseline old.json to compare times against an earlier run.
+The exit code is 1 if any time grew by more than --tolerance.
+"""
+import os
+import sys
+import json
+import time
+import shlex
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+
+import numpy as np
+
+# Note: mpi_list (and so MPI) is only imported by the
+# benchmark runs, since the --procs driver launches mpirun.
+
+def elems(C, kind, n, size):
+    # n elements in total, each holding `size` floats
+    dfm = C.iterates(n)
+    if kind == "array":
+        return dfm.map(lambda i: np.full(size, float(i)))
+    return dfm.map(lambda i: [float(i)]*size)
+
+def add(a, b):
+    if isinstance(a, np.ndarray):
+        return a + b
+    return [x+y for x, y in zip(a, b)]
+
+def b_reduce(dfm, kind, size):
+    dfm.reduce(add, np.zeros(size) if kind == "array" else [0.0]*size)
+
+def b_scan(dfm, kind, size):
+    dfm.scan(add)
+
+def b_collect(dfm, kind, size):
+    dfm.collect()
+
+def b_group(dfm, kind, size):
+    N = max(1, len(dfm.E)*dfm.C.procs)
+    def f(e, out):
+        out.setdefault(int(e[0])*7919 % N, []).append(e)
+    dfm.group(f, lambda x: x, N)
+
+def b_repartition(dfm, kind, size):
+    N = max(1, len(dfm.E)*dfm.C.procs // 2)
+    if kind == "array":
+        concat = np.concatenate
+    else:
+        concat = lambda x: sum(x, [])
+    dfm.repartition(len, lambda e, idx: [e[i:j] for i, j in idx], concat, N)
+
+def ramp(dfm, n):
+    # Element i keeps about 2*i/n of its items, so later
+    # ranks hold more items, and repartition must move data.
+    return dfm.map(lambda e: e[:1 + len(e)*2*int(e[0]) // n])
+
+def b_send_items(dfm, kind, size):
+    # every rank sends all of its elements to the next rank
+    from mpi_list.gather import send_items
+    C = dfm.C
+    prev = (C.rank - 1) % C.procs
+    nxt = (C.rank + 1) % C.procs
+    sched = [(prev, prev, C.rank, C.rank)]
+    if nxt != C.rank:
+        sched.append( (C.rank, C.rank, nxt, nxt) )
+    send_items(C, [dfm.E], sched)
+
+ops = { "reduce": b_reduce,
+        "scan": b_scan,
+        "collect": b_collect,
+        "group": b_group,
+        "repartition": b_repartition,
+        "send_items": b_send_items }
+
+# input preparation (untimed), for ops that need it
+prep = { "repartition": ramp }
+
+def proc_status(key):
+    # bytes, from a "kB" line of /proc/self/status (None if unavailable)
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(key + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def reset_peak():
+    # Reset the peak RSS (where possible), and return the current RSS.
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return peak_rss()
+    return proc_status("VmRSS")
+
+def peak_rss():
+    # bytes (ru_maxrss is KiB on Linux, bytes on macOS)
+    r = proc_status("VmHWM")
+    if r is not None:
+        return r
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return r if sys.platform == "darwin" else r*1024
+
+def run_one(C, T, op, kind, n, size, reps):
+    fn = ops[op]
+    make = lambda C: prep.get(op, lambda d, n: d)(elems(C, kind, n, size), n)
+    dfm = make(C)
+    best = None
+    rss = (0, 0) # (growth, peak) of the largest growth
+    for k in range(reps):
+        C.comm.Barrier()
+        base = reset_peak()
+        t0 = time.perf_counter()
+        fn(dfm, kind, size)
+        t = C.comm.allreduce(time.perf_counter() - t0, op=C.MPI.MAX)
+        best = t if best is None else min(best, t)
+        peak = peak_rss()
+        rss = max(rss, (max(0, peak - base), peak))
+
+    # count bytes in a separate, traced run
+    T.tracer.events = []
+    fn(make(T), kind, size)
+    sent = sum(s["bytes_sent"] for s in T.tracer.summary().values())
+    sent = C.comm.allreduce(sent)
+    rss = C.comm.allreduce(rss, op=C.MPI.MAX)
+    return { "op": op, "kind": kind, "n": n, "size": size,
+             "procs": C.procs, "time": best, "bytes": sent,
+             "rss": rss[1] / 2**20, "rss_delta": rss[0] / 2**20 }
+
+def run(args):
+    from mpi_list import Context
+    C = Context()
+    T = Context()
+    T.enable_trace()
+    results = []
+    for op in args.ops:
+        for kind in args.kinds:
+            for n in args.counts:
+                if args.weak:
+                    n *= C.procs
+                for size in args.sizes:
+                    r = run_one(C, T, op, kind, n, size, args.reps)
+                    results.append(r)
+                    if C.rank == 0 and args.verbose:
+                        print(fmt(r), flush=True)
+    if C.rank == 0:
+        return { "meta": meta(C, args), "results": results }
+
+def meta(C, args):
+    return { "procs": C.procs,
+             "weak": args.weak,
+             "reps": args.reps,
+             "python": platform.python_version(),
+             "numpy": np.__version__,
+             "mpi": C.MPI.Get_library_version().splitlines()[0].strip("\x00 "),
+             "host": platform.node() }
+
+def fmt(r):
+    return (f"{r['op']:12s} {r['kind']:5s} procs={r['procs']:<3d} "
+            f"n={r['n']:<8d} size={r['size']:<6d} "
+            f"{r['time']*1e3:10.3f} ms {r['bytes']/2**10:12.1f} KiB "
+            f"rss={r['rss']:8.1f} MiB ({r.get('rss_delta', 0.0):+.1f})")
+
+def sweep(args, argv):
+    # Launch one mpirun per rank count and merge their results.
+    out = { "meta": None, "results": [] }
+    for k in args.procs:
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "bench.json")
+            cmd = shlex.split(args.mpirun) + ["-np", str(k),
+                    sys.executable, os.path.abspath(__file__)] \
+                  + argv + ["-o", fname]
+            subprocess.run(cmd, check=True)
+            with open(fname) as f:
+                ans = json.load(f)
+        out["meta"] = ans["meta"]
+        out["results"].extend(ans["results"])
+    out["meta"]["procs"] = args.procs
+    return out
+
+def key(r):
+    return (r["op"], r["kind"], r["n"], r["size"], r["procs"])
+
+def compare(ans, base, tol):
+    """Print the time ratio against the baseline
+    for every matching result.
+
+    Returns:
+        number of results slower than tol * baseline
+    """
+    old = { key(r): r for r in base["results"] }
+    slow = 0
+    for r in ans["results"]:
+        b = old.get(key(r))
+        if b is None:
+            continue
+        ratio = r["time"] / max(b["time"], 1e-9)
+        flag = ""
+        if ratio > tol:
+            flag = "  <-- slower"
+            slow += 1
+        print(f"{fmt(r)}  x{ratio:.2f}{flag}")
+    return slow
+
+def parse(argv):
+    ints = lambda s: [int(x) for x in s.split(",")]
+    strs = lambda s: s.split(",")
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("-o", "--out", help="output JSON file")
+    p.add_argument("--ops", type=strs, default=list(ops),
+                   help="comma-separated operations (default: all)")
+    p.add_argument("--kinds", type=strs, default=["obj", "array"])
+    p.add_argument("--counts", type=ints, default=[1000, 10000],
+                   help="element counts")
+    p.add_argument("--sizes", type=ints, default=[16, 1024],
+                   help="floats per element")
+    p.add_argument("--reps", type=int, default=3)
+    p.add_argument("--weak", action="store_true",
+                   help="counts are per rank (weak scaling)")
+    p.add_argument("--procs", type=ints,
+                   help="rank counts to sweep (launches mpirun)")
+    p.add_argument("--mpirun", default="mpirun",
+                   help="launcher command for --procs")
+    p.add_argument("--baseline", help="earlier JSON output to compare with")
+    p.add_argument("--tolerance", type=float, default=1.2,
+                   help="flag times above tolerance * baseline")
+    p.add_argument("-v", "--verbose", action="store_true")
+    return p.parse_args(argv)
+
+def main(argv):
+    args = parse(argv)
+    if args.procs is not None:
+        # arguments passed through to each run
+        sub = list(argv)
+        i = sub.index("--procs")
+        del sub[i:i+2]
+        for opt in ["-o", "--out", "--baseline", "--mpirun", "--tolerance"]:
+            while opt in sub:
+                i = sub.index(opt)
+                del sub[i:i+2]
+        ans = sweep(args, sub)
+    else:
+        ans = run(args)
+        if ans is None: # not rank 0
+            return 0
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(ans, f, indent=1)
+    slow = 0
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            slow = compare(ans, json.load(f), args.tolerance)
+    elif args.procs is None and not args.verbose: # (sweep runs print their own)
+        for r in ans["results"]:
+            print(fmt(r))
+    return 1 if slow > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
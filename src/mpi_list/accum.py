@@ -0,0 +1,140 @@
+# Accumulators: values updated locally during map/filter/flatMap
+# and merged across ranks in one batch at the next action.
+from copy import deepcopy
+import operator
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .reducer import Reducer, CommReducer
+
+# named ops that can be packed into a single Allreduce
+_ops = { 'sum':  (operator.add, 'SUM'),
+         'prod': (operator.mul, 'PROD'),
+         'min':  (lambda a,b: np.minimum(a,b) if np is not None else min(a,b), 'MIN'),
+         'max':  (lambda a,b: np.maximum(a,b) if np is not None else max(a,b), 'MAX'),
+       }
+
+class Accumulator:
+    """Value updated locally on each rank, and merged
+    across ranks at the next DFM action.
+
+    Created by `Context.accumulator`.  Call `add` from
+    inside functions passed to map, filter, flatMap, etc.::
+
+        dropped = C.accumulator(0)
+        def keep(e):
+            if e < 0:
+                dropped.add(1)
+                return False
+            return True
+        n = dfm.filter(keep).len() # also merges `dropped`
+        print(dropped.value)
+        dropped.free()
+
+    Note:
+        Accumulators must be created in the same order on every rank.
+        `zero` should be the identity of `op`, and its type
+        fixes the type of the merged value (e.g. use 0.0 to
+        sum floats).
+
+    Attributes:
+        value: global value as of the last merge
+               (the same on all ranks)
+        local: this rank's pending, un-merged contribution
+
+    """
+    def __init__(self, zero, op='sum', C=None):
+        self.C = C
+        self.zero = zero
+        self.op = op
+        if isinstance(op, str):
+            self.fn = _ops[op][0]
+        else:
+            self.fn = op
+        self.value = deepcopy(zero)
+        self.local = deepcopy(zero)
+
+    def add(self, x):
+        """Combine x into the local value."""
+        self.local = self.fn(self.local, x)
+
+    def free(self):
+        """Stop merging this accumulator at each action.
+
+        Pending (un-merged) local updates are discarded, and
+        `value` keeps its last merged result.
+        This must be called in the same order on all ranks.
+        """
+        if self.C is not None:
+            self.C.accumulators.remove(self)
+            self.C = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.free()
+
+    def packable(self):
+        # Can local be sent as part of a numeric Allreduce?
+        # Decided from `zero`, so all ranks agree.
+        if np is None or not isinstance(self.op, str):
+            return False
+        if isinstance(self.zero, bool) or not isinstance(self.zero,
+                        (int, float, np.number, np.ndarray)):
+            return False
+        return np.asarray(self.zero).dtype.kind in 'iuf'
+
+    def merge(self, total):
+        # Fold the merged contribution of all ranks into `value`.
+        self.value = self.fn(self.value, total)
+        self.local = deepcopy(self.zero)
+
+def merge_all(C, accs):
+    """Merge all pending accumulators.
+
+    Numeric accumulators with named ops are packed into one
+    vector per (op, dtype) and merged by a single Allreduce.
+    All others are merged together in a single
+    CommReducer + bcast.
+
+    Note:
+        This must be called by all ranks, with the same
+        list of accumulators.
+
+    Args:
+        C: Context
+        accs: [Accumulator]
+    """
+    groups = {} # (op, dtype) : [acc]
+    other = []
+    for a in accs:
+        if a.packable():
+            key = (a.op, np.asarray(a.zero).dtype.str)
+            groups.setdefault(key, []).append(a)
+        else:
+            other.append(a)
+
+    for (op, dtype), grp in sorted(groups.items()):
+        vals = [np.asarray(a.local, dtype=dtype) for a in grp]
+        buf = np.concatenate([v.ravel() for v in vals])
+        C.comm.Allreduce(C.MPI.IN_PLACE, buf, op=getattr(C.MPI, _ops[op][1]))
+        k = 0
+        for a, v in zip(grp, vals):
+            x = buf[k:k+v.size].reshape(v.shape)
+            k += v.size
+            if not isinstance(a.zero, np.ndarray):
+                x = type(a.zero)(x.item())
+            a.merge(x)
+
+    if len(other) > 0:
+        def comb(x, y):
+            return [a.fn(u,v) for a,u,v in zip(other,x,y)]
+        R = Reducer(comb, [a.local for a in other])
+        tot = CommReducer(C, R)()
+        tot = C.comm.bcast(tot)
+        for a, x in zip(other, tot):
+            a.merge(x)
@@ -0,0 +1,165 @@
+# Checkpoint / restart of DFM elements.
+#
+# Every rank writes its own partition file in parallel:
+#
+#   part-XXXXX.npz -- when all elements are (non-object) arrays,
+#                     one array per element, loadable separately
+#   part-XXXXX.pkl -- otherwise, elements pickled one after another,
+#                     followed by a pickled list of their byte
+#                     offsets and (last 8 bytes) the offset of that list
+#
+# Then rank 0 writes manifest.json, recording the element count
+# and format of each partition.  The manifest is written last,
+# so a checkpoint without one is incomplete.
+#
+# On restore, each rank reads the slices of partition files
+# that it owns (see `segments`), so no data is sent between ranks.
+import os
+import json
+import pickle
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .segment import even_spread, cumsum, segments
+
+MANIFEST = "manifest.json"
+
+def _part(path, rank, fmt):
+    return os.path.join(path, f"part-{rank:05d}.{fmt}")
+
+def _write_npz(fname, E):
+    with open(fname, "wb") as f:
+        np.savez(f, *E)
+
+def _write_pkl(fname, E):
+    with open(fname, "wb") as f:
+        off = []
+        for e in E:
+            off.append(f.tell())
+            pickle.dump(e, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pos = f.tell()
+        pickle.dump(off, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.write(pos.to_bytes(8, "little"))
+
+def _read_npz(fname, i0, i1):
+    with np.load(fname, allow_pickle=False) as z:
+        return [z[f"arr_{i}"] for i in range(i0, i1)]
+
+def _read_pkl(fname, i0, i1):
+    with open(fname, "rb") as f:
+        f.seek(-8, os.SEEK_END)
+        f.seek(int.from_bytes(f.read(8), "little"))
+        off = pickle.load(f)
+        if i1 > i0:
+            f.seek(off[i0])
+        return [pickle.load(f) for i in range(i0, i1)]
+
+def _error(e):
+    # picklable (is it an OSError?, description) for exception e
+    return (isinstance(e, OSError), f"{type(e).__name__}: {e}")
+
+def _check(errs):
+    # Raise on [(rank, error or None)], if any rank failed.
+    errs = [(r, e) for r, e in errs if e is not None]
+    if len(errs) == 0:
+        return
+    msg = "checkpoint failed -- " + "; ".join(
+                f"rank {r}: {e[1]}" for r, e in errs)
+    if all(e[0] for r, e in errs):
+        raise OSError(msg)
+    raise RuntimeError(msg)
+
+def write_checkpoint(C, E, path):
+    """Write the local elements, E, to a checkpoint directory.
+
+    Note:
+        This must be called by all ranks.
+
+    Raises:
+        OSError: (on all ranks) if any rank failed to write.
+        RuntimeError: (on all ranks) if any rank failed
+                      otherwise (e.g. an element can not be pickled).
+    """
+    err = None
+    if C.rank == 0:
+        try:
+            os.makedirs(path, exist_ok=True)
+            if os.path.exists(os.path.join(path, MANIFEST)):
+                os.remove(os.path.join(path, MANIFEST))
+        except OSError as e:
+            err = _error(e)
+    _check([(0, C.comm.bcast(err))])
+
+    fmt = "pkl"
+    if np is not None and len(E) > 0 and all(
+            isinstance(e, np.ndarray) and not e.dtype.hasobject for e in E):
+        fmt = "npz"
+    try:
+        if fmt == "npz":
+            _write_npz(_part(path, C.rank, fmt), E)
+        else:
+            _write_pkl(_part(path, C.rank, fmt), E)
+    except Exception as e: # every rank must reach the allgather
+        err = _error(e)
+
+    info = C.comm.allgather((len(E), fmt, err))
+    _check([(r, x[2]) for r, x in enumerate(info)])
+    if C.rank == 0:
+        man = { "version": 1,
+                "procs": C.procs,
+                "counts": [x[0] for x in info],
+                "formats": [x[1] for x in info] }
+        try:
+            tmp = os.path.join(path, MANIFEST + ".tmp")
+            with open(tmp, "w") as f:
+                json.dump(man, f)
+            os.replace(tmp, os.path.join(path, MANIFEST))
+        except OSError as e:
+            err = _error(e)
+    _check([(0, C.comm.bcast(err))])
+
+def read_checkpoint(C, path):
+    """Read this rank's elements from a checkpoint directory.
+
+    With the same number of ranks as the checkpoint,
+    every rank gets back its original elements.
+    Otherwise, elements are spread evenly (in order).
+
+    Note:
+        This must be called by all ranks.
+
+    Returns:
+        [elem]
+
+    Raises:
+        FileNotFoundError: (on all ranks) if there is no complete
+                           checkpoint at path.
+    """
+    man = None
+    if C.rank == 0:
+        try:
+            with open(os.path.join(path, MANIFEST)) as f:
+                man = json.load(f)
+        except FileNotFoundError:
+            pass
+    man = C.comm.bcast(man)
+    if man is None:
+        raise FileNotFoundError(f"No checkpoint manifest in {path}")
+
+    counts = man["counts"]
+    if len(counts) == C.procs:
+        tgt = counts
+    else:
+        tgt = even_spread(sum(counts), C.procs)
+
+    E = []
+    for s in segments(cumsum(counts), cumsum(tgt)):
+        if s.dst != C.rank:
+            continue
+        fmt = man["formats"][s.src]
+        read = _read_npz if fmt == "npz" else _read_pkl
+        E.extend( read(_part(path, s.src, fmt), s.s0, s.s1) )
+    return E
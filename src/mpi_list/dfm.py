@@ -1,11 +1,48 @@
+import random
+import heapq
+import pickle
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # schedule regrouping
 from .segment import even_spread, cumsum, segments
 # gather / repartition sends
-from .gather import gather_partitions, send_items
+from .gather import gather_partitions, send_items, group_arrays, \
+                    serve_chunks, pull_chunks
 # reduce
-from .reducer import Reducer, CommReducer
+from .reducer import Reducer, HierReducer
 # prefix scan
 from .pscan import psched
+# shared-memory data
+from .shared import Broadcast
+# object serialization
+from .serial import wrap
+# work-stealing map
+from .steal import map_dynamic
+# accumulators
+from .accum import Accumulator, merge_all
+# tracing
+from .trace import Tracer, traced, null_span, count, write_trace
+# approximate summaries
+from .sketch import HyperLogLog, QuantileSketch
+# checkpoint / restart
+from .checkpoint import write_checkpoint, read_checkpoint
+# streaming
+from .stream import Stream
+# cached repartition schedules
+from .plan import Plan
+# out-of-core group
+from .spill import gather_spill
+# partitioning metadata
+from .partition import BlockPartitioner, HashPartitioner, IndexPartitioner, keyed
+# calibrated message sizes
+from . import tune
+
+WINDOW_TAG = 57
+CART_TAG = 58
 
 class DFM:
     """Distributed Free Monoid = A list of something.
@@ -16,35 +53,83 @@ class DFM:
     Attributes:
         C: Reference to the Context object
         E: List of local elements.
+        part: what is known about how elements are
+              laid out over ranks (see `mpi_list.partition`),
+              or None
 
     """
-    def __init__(self, C, E):
+    def __init__(self, C, E, part=None):
         self.C = C
         self.E = E
+        self.part = part
 
+    @traced
     def len(self):
         """Number of elements in DFM (returned to all ranks)
 
         Returns:
             int : total size
         """
+        self.C.sync()
         return self.C.comm.allreduce(len(self.E))
 
-    def map(self, f):
+    @traced
+    def map(self, f, preservesPartitioning=False):
         """Map over elements.
 
         Args:
             f: function of type = elem -> new elem
+            preservesPartitioning: set this if f keeps the
+                   key of (key, value) pairs, so the result
+                   keeps this DFM's key partitioning
 
         Returns:
             new DFM
 
         """
-        return DFM(self.C, [f(e) for e in self.E])
+        return DFM(self.C, [f(e) for e in self.E],
+                   self._mapped_part(preservesPartitioning))
+
+    def _mapped_part(self, preserves):
+        # The block layout survives any map (local counts are unchanged).
+        if preserves or self.part == BlockPartitioner():
+            return self.part
+        return None
     
+    @traced
+    def map_dynamic(self, f):
+        """Map over elements, with dynamic load balancing.
+
+        Like `map`, but ranks that run out of work steal
+        unprocessed elements from other ranks.  Use this when
+        the cost of `f` varies widely between elements.
+        The results are returned to the rank owning each
+        input element, so the output has the same layout as `map`.
+
+        Note:
+            Stolen elements (and their results) are pickled
+            and sent between ranks, so this only pays
+            off when `f` is expensive compared to sending `e`.
+
+        Args:
+            f: function of type = elem -> new elem
+
+        Returns:
+            new DFM
+
+        """
+        return DFM(self.C, map_dynamic(self.C, self.E, f),
+                   self._mapped_part(False))
+
+    @traced
     def filter(self, f):
         """Filter, removing some elements.
 
+        If `C.auto_balance` is set, the result is
+        rebalanced when its load imbalance exceeds that threshold
+        (see `rebalance`) -- unless it has a known partitioning
+        (`part`), since that would undo it.
+
         Args:
             f: function of type = elem -> bool
 
@@ -52,11 +137,20 @@ class DFM:
             new DFM
 
         """
-        return DFM(self.C, [e for e in self.E if f(e)])
+        part = None if self.part == BlockPartitioner() else self.part
+        ans = DFM(self.C, [e for e in self.E if f(e)], part)
+        if self.C.auto_balance is not None and part is None:
+            ans = ans.rebalance(self.C.auto_balance)
+        return ans
 
+    @traced
     def flatMap(self, f): # applyM
         """Map over elements and concatenate all results.
 
+        If `C.auto_balance` is set, the result is
+        rebalanced when its load imbalance exceeds that threshold
+        (see `rebalance`).
+
         Args:
             f: function of type = elem -> [new elem]
 
@@ -67,9 +161,56 @@ class DFM:
         ans = []
         for e in self.E:
             ans.extend( f(e) )
-        return DFM(self.C, ans)
+        ans = DFM(self.C, ans)
+        if self.C.auto_balance is not None:
+            ans = ans.rebalance(self.C.auto_balance)
+        return ans
 
-    def reduce(self, f, x0, distribute=True):
+    @traced
+    def rebalance(self, threshold=None):
+        """Redistribute elements evenly over ranks.
+
+        Whole elements are moved (never split), so that
+        rank r ends up with the same number of elements it would
+        get from `C.iterates` -- while preserving global order.
+
+        Args:
+            threshold: if given, only rebalance when the
+                       largest local size exceeds
+                       threshold * (mean local size)
+
+        Returns:
+            DFM (self, if no rebalancing was needed)
+        """
+        if self.part == BlockPartitioner():
+            return self
+        rank = self.C.rank
+        counts = self.C.comm.allgather(len(self.E))
+        total = sum(counts)
+        if threshold is not None and \
+                max(counts) <= threshold * total / self.C.procs:
+            return self
+        tgt = even_spread(total, self.C.procs)
+        if counts == tgt:
+            return self
+
+        local = []
+        sched = []
+        for i,s in enumerate(segments(cumsum(counts), cumsum(tgt))):
+            if s.src == rank:
+                local.append(self.E[s.s0:s.s1])
+                sched.append((i, s.src, s.dst, s.dst))
+            elif s.dst == rank:
+                sched.append((i, s.src, s.dst, s.dst))
+
+        ans = []
+        for grp in send_items(self.C, local, sched):
+            for blk in grp:
+                ans.extend(blk)
+        return DFM(self.C, ans, BlockPartitioner())
+
+    @traced
+    def reduce(self, f, x0, distribute=True, seq=None, fold=None):
         """Reduce the dataset to a value.
 
         Apply an associative, pairwise reduction to the dataset.
@@ -86,12 +227,16 @@ class DFM:
         This is indicated in the function's type with `*elem`.
 
         Each rank calls `x0 = f(x0, e)` on all its elements,
-        then does a fan-in reduction on x0.  You can
-        technically implement a different function for each
-        phase by detecting whether `e` has the type
-        of x0 or the type of an element.
-        In fact, this is the only way to get around the
-        restriction that `type(x0) == type(e)`.
+        then does a fan-in reduction on x0 using `f`.
+        When the accumulated type differs from the element type,
+        pass a separate per-element function, `seq`,
+        (used as `x0 = seq(x0, e)`) or a function
+        folding the whole local list at once, `fold`
+        (used as `x0 = fold(x0, E)`).  Then `f` is only
+        used to merge results between ranks.  For example,
+        counting elements::
+
+            n = dfm.reduce(lambda a,b: a+b, 0, fold=lambda a,E: a+len(E))
 
         Note:
             `x0` may be updated in-place. Even if you do this,
@@ -106,19 +251,82 @@ class DFM:
                and return it.
             x0: the "zero" value of the first argument
             distribute: Distribute the answer from rank 0 to all ranks?
+            seq: (optional) per-element function of type = *a, elem -> *a
+                 (f then has type = *a, a -> *a)
+            fold: (optional) function of type = *a, [elem] -> *a
+                 applied once to the local elements (takes
+                 precedence over `seq`)
 
         Returns:
-            elem
+            elem (or a when using seq/fold)
 
         """
-        R = Reducer(f, x0)
-        for e in self.E:
-            R(e)
-        x0 = CommReducer(self.C,R)()
+        self.C.sync()
+        # only array reductions can use shared memory
+        shared = None if np is not None and isinstance(x0, np.ndarray) \
+                      else False
+        R = Reducer(f if seq is None else seq, x0, comb=f)
+        if fold is not None:
+            R.data = fold(R.data, self.E)
+        else:
+            for e in self.E:
+                R(e)
+        x0 = HierReducer(self.C, R, shared)()
         if distribute:
             x0 = self.C.comm.bcast(x0)
         return x0
 
+    @traced
+    def aggregate(self, *specs, distribute=True):
+        """Compute several reductions in one pass.
+
+        Each spec is a tuple, `(x0, seqOp, combOp)`.
+        Every rank runs `x0 = seqOp(x0, e)` over its elements
+        for all specs in a single loop, then the
+        per-rank results are merged with `combOp`
+        in a single fan-in reduction.
+
+        For example, count, sum and max together::
+
+            n, s, m = dfm.aggregate(
+                        (0, lambda a,e: a+1, lambda a,b: a+b),
+                        (0, lambda a,e: a+e, lambda a,b: a+b),
+                        (None, lambda a,e: e if a is None else max(a,e),
+                               lambda a,b: a if b is None else
+                                          (b if a is None else max(a,b))) )
+
+        Note:
+            As with `reduce`, each x0 may be updated in-place,
+            and must represent the starting value for a single rank.
+
+        Args:
+            specs: (x0, seqOp, combOp) tuples, where
+                   seqOp has type = *a, elem -> *a
+                   combOp has type = *a, a -> *a
+            distribute: Distribute the answer from rank 0 to all ranks?
+
+        Returns:
+            [a] -- one result per spec
+        """
+        self.C.sync()
+        accs = [spec[0] for spec in specs]
+        seqs = [spec[1] for spec in specs]
+        combs = [spec[2] for spec in specs]
+        for e in self.E:
+            for i, f in enumerate(seqs):
+                accs[i] = f(accs[i], e)
+
+        def comb(a, b):
+            for i, f in enumerate(combs):
+                a[i] = f(a[i], b[i])
+            return a
+        R = Reducer(None, accs, comb=comb)
+        ans = HierReducer(self.C, R, shared=False)()
+        if distribute:
+            ans = self.C.comm.bcast(ans)
+        return ans
+
+    @traced
     def scan(self, f):
         """Perform a parallel prefix-scan on the dataset.
 
@@ -147,18 +355,38 @@ class DFM:
         if len(pre) > 0:
             last = [ pre[-1] ]
 
+        with self.C.span("scan_exchange") as info:
+            last = self._scan_exchange(f, last, info)
+
+        # distribute incoming prefix scan (if non-empty)
+        if len(last) > 0:
+            for i in range(len(pre)):
+                pre[i] = f(last[0], pre[i])
+
+        return DFM(self.C, pre)
+
+    def _scan_exchange(self, f, last, info):
+        # Exchange the last values of each rank's local scan,
+        # returning the prefix from all prior ranks ([] if none).
+        rank = self.C.rank
+        procs = self.C.procs
+
         # send last val. to rank+1 nbr
         if rank % 2 == 0: # even ranks send first
             if rank != procs-1:
                 self.C.comm.send(last, dest=rank+1, tag=10)
+                count(self.C, info, "bytes_sent", last)
             if rank == 0:
                 recv = []
             else:
                 recv = self.C.comm.recv(source=rank-1, tag=11)
+                count(self.C, info, "bytes_recv", recv)
         else: # odd ranks recv first
             recv = self.C.comm.recv(source=rank-1, tag=10)
+            count(self.C, info, "bytes_recv", recv)
             if rank != procs-1:
                 self.C.comm.send(last, dest=rank+1, tag=11)
+                count(self.C, info, "bytes_sent", last)
         last = recv
 
         # ranks 1, ..., procs-1 participate in prefix scan
@@ -172,23 +400,165 @@ class DFM:
                        and vrank < sl.stop \
                        and (vrank - sl.start)%sl.step == 0:
                     self.C.comm.send(last, dest=rank+off, tag=i)
+                    count(self.C, info, "bytes_sent", last)
                 # receiving rank?
                 elif vrank >= sl.start+off \
                        and (vrank - sl.start-off)%sl.step == 0:
                     u = self.C.comm.recv(source=rank-off, tag=i)
+                    count(self.C, info, "bytes_recv", u)
                     if len(last) == 0:
                         last = u
                     elif len(u) != 0:
                         last = [ f(u[0], last[0]) ]
                     # else u == [] and last remains unchanged
+        return last
 
-        # distribute incoming prefix scan (if non-empty)
-        if len(last) > 0:
-            for i in range(len(pre)):
-                pre[i] = f(last[0], pre[i])
+    @traced
+    def window(self, k, f):
+        """Apply f to every run of k consecutive elements
+        (moving averages, frame differences, ...).
 
-        return DFM(self.C, pre)
+        Each rank receives the k-1 elements following its
+        last one (from as many later ranks as needed) with
+        non-blocking sends, while it computes the windows
+        that lie entirely within its own elements.
+
+        Args:
+            k: window length (>= 1)
+            f: function of type = [elem] -> new elem,
+               called on lists of length k
+
+        Returns:
+            DFM of n-k+1 new elems (none if n < k), where
+            element i is f([e_i, ..., e_{i+k-1}]) and lives
+            on the rank holding e_i.
+        """
+        if k < 1:
+            raise ValueError("window length must be >= 1")
+        rank = self.C.rank
+        counts = self.C.comm.allgather(len(self.E))
+        off = cumsum(counts)
+        n = off[-1]
+        nwin = max(0, min(off[rank+1], n-k+1) - off[rank])
+
+        def halo(r):
+            # global index range rank r needs from later ranks
+            if counts[r] == 0:
+                return (0, 0)
+            return (off[r+1], min(off[r+1]+k-1, n))
+
+        with self.C.span("window_exchange") as info:
+            # send my elements to earlier ranks whose halo covers them
+            reqs = []
+            for r in range(rank):
+                lo, hi = halo(r)
+                lo = max(lo, off[rank])
+                hi = min(hi, off[rank+1])
+                if lo < hi:
+                    x = self.E[lo-off[rank] : hi-off[rank]]
+                    count(self.C, info, "bytes_sent", x)
+                    reqs.append(self.C.comm.isend(x, dest=r, tag=WINDOW_TAG))
+
+            # interior windows
+            ans = [f(self.E[i:i+k]) for i in range(min(nwin, len(self.E)-k+1))]
+
+            # windows crossing into later ranks
+            lo, hi = halo(rank)
+            if lo < hi:
+                s0 = max(0, len(self.E)-k+1)
+                ext = self.E[s0:] # ext[j] is local element s0+j
+                for r in range(rank+1, self.C.procs):
+                    if off[r] >= hi:
+                        break
+                    if counts[r] > 0:
+                        x = self.C.comm.recv(source=r, tag=WINDOW_TAG)
+                        count(self.C, info, "bytes_recv", x)
+                        ext.extend(x)
+                for i in range(len(ans), nwin):
+                    ans.append( f(ext[i-s0 : i-s0+k]) )
+            for req in reqs:
+                req.wait()
+        return DFM(self.C, ans)
+
+    @traced
+    def cartesian(self, other, f):
+        """Apply f to all pairs of elements from this DFM and `other`
+        (distance matrices, pairwise contacts, ...).
+
+        The blocks of `other` rotate around a ring of ranks, so
+        each rank holds only its own block and the one in transit.
+        While computing on the current block, a rank sends it on
+        and receives the next one: between rows, it polls for the
+        next block's message and starts receiving it as soon as
+        it arrives.
 
+        Args:
+            other: DFM (on the same Context)
+            f: function of type = elem, other elem -> new elem
+
+        Returns:
+            DFM of n*m new elems, in row-major order:
+            element i*m + j is f(a_i, b_j), and the whole row i
+            lives on the rank holding a_i.
+        """
+        assert other.C is self.C, "cartesian: both DFMs must share a Context"
+        rank = self.C.rank
+        procs = self.C.procs
+        comm = self.C.comm
+        nbr = (rank+1) % procs
+        blk = other.E
+        # rows[i][r] = results of element i with the block of rank r
+        rows = [ [None]*procs for a in self.E ]
+        rreq = None
+        def poll():
+            # start receiving the next block, if it has arrived
+            # (pkl5 has no irecv, but its messages do)
+            nonlocal rreq
+            if rreq is None:
+                msg = comm.improbe(source=nbr, tag=CART_TAG)
+                if msg is not None:
+                    rreq = msg.irecv()
+
+        with self.C.span("cartesian_ring") as info:
+            for s in range(procs):
+                more = s < procs-1
+                rreq = None
+                if more: # pass the block on to rank-1
+                    count(self.C, info, "bytes_sent", blk)
+                    req = comm.isend(blk, dest=(rank-1) % procs, tag=CART_TAG)
+                    poll()
+                src = (rank+s) % procs
+                for row, a in zip(rows, self.E):
+                    row[src] = [f(a, b) for b in blk]
+                    if more:
+                        poll()
+                if more:
+                    if rreq is None:
+                        rreq = comm.mprobe(source=nbr, tag=CART_TAG).irecv()
+                    blk = rreq.wait()
+                    count(self.C, info, "bytes_recv", blk)
+                    req.wait()
+
+        ans = []
+        for row in rows:
+            for part in row:
+                ans.extend(part)
+        return DFM(self.C, ans)
+
+    def allpairs(self, f):
+        """Apply f to all ordered pairs of elements
+        (see `cartesian`).
+
+        Args:
+            f: function of type = elem, elem -> new elem
+
+        Returns:
+            DFM of n*n new elems, where element i*n + j
+            is f(e_i, e_j).
+        """
+        return self.cartesian(self, f)
+
+    @traced
     def collect(self, root=0):
         """Collect all the elements to the root rank.
 
@@ -210,17 +580,99 @@ class DFM:
 
         """
 
-        if root is None:
-            lE = self.C.comm.allgather(self.E)
-        else:
-            lE = self.C.comm.gather(self.E, root=root)
-        if self.C.rank != root:
+        self.C.sync()
+        with self.C.span("collect_gather") as info:
+            lE = self._gather(root, info)
+        if root is not None and self.C.rank != root:
             return None
         ans = []
         for x in lE:
             ans.extend(x)
         return ans
 
+    @traced
+    def collect_iter(self, root=0, chunk=None):
+        """Iterate over all elements on the root rank,
+        in global order, without holding them all at once.
+
+        Root pulls `chunk` elements at a time from each rank in
+        turn (requesting the next chunk before yielding the current
+        one), so at most about two chunks are held at once.
+
+        Other ranks serve root's requests inside this call,
+        and return an empty iterator once root has
+        read all their elements or stopped early.
+        So, a loop like `for e in dfm.collect_iter(): ...`
+        works on all ranks.
+
+        Note:
+            Root must exhaust or close the iterator
+            (e.g. by breaking out of a for-loop over it),
+            otherwise the other ranks wait forever.
+
+        Args:
+            root: rank receiving the elements
+            chunk: elements per message (default: a whole partition)
+
+        Returns:
+            iterator over all elems on root, and an empty iterator elsewhere
+        """
+        self.C.sync()
+        if self.C.rank != root:
+            serve_chunks(self.C, self.E, root, chunk)
+            return iter(())
+        return pull_chunks(self.C, self.E, root, chunk)
+
+    @traced
+    def collect_to(self, path, root=0, chunk=1024, write=None):
+        """Stream all elements, in global order, to a file on root.
+
+        Args:
+            path: output file (written by root)
+            root: rank writing the file
+            chunk: elements per message (see `collect_iter`)
+            write: function of type = file, elem -> ()
+                   (default: pickle.dump each elem, so the
+                   file can be read back with repeated
+                   pickle.load calls)
+
+        Returns:
+            number of elements written (on root), None elsewhere
+        """
+        it = self.collect_iter(root, chunk)
+        if self.C.rank != root:
+            return None
+        if write is None:
+            write = lambda f, e: pickle.dump(e, f, pickle.HIGHEST_PROTOCOL)
+        n = 0
+        with open(path, "wb") as f:
+            for e in it:
+                write(f, e)
+                n += 1
+        return n
+
+    def _gather(self, root, info):
+        # list of all ranks' local lists (on root)
+        H = None
+        if root == 0 and self.C.hierarchical:
+            H = self.C.hierarchy()
+        if root is None:
+            lE = _counted_gather(self.C, self.E, None, info)
+        elif H is not None:
+            # gather on-node first, so only node leaders
+            # send over the network
+            node, leaders = H
+            lE = _counted_gather(node, self.E, 0, info)
+            if leaders is not None:
+                nE = []
+                for x in lE:
+                    nE.extend(x)
+                lE = _counted_gather(leaders, nE, 0, info)
+        else:
+            lE = _counted_gather(self.C, self.E, root, info)
+        return lE
+
+    @traced
     def nodeMap(self, f):
         """map over the MPI ranks.
 
@@ -244,27 +696,223 @@ class DFM:
         assert isinstance(ans, list), f"nodeMap: f must return a list (got {type(f)})"
         return DFM(self.C, ans)
 
+    @traced
+    def checkpoint(self, path):
+        """Save all elements to the directory `path`.
+
+        Every rank writes its own partition file in parallel
+        (.npz when all its elements are arrays, pickle otherwise),
+        then rank 0 writes a manifest of the partition layout.
+        Reload with `Context.restore`.
+
+        Note:
+            `path` must be on a filesystem visible to all ranks.
+
+        Args:
+            path: output directory (created if needed)
+
+        Returns:
+            self
+
+        Raises:
+            OSError, RuntimeError: on all ranks, if any
+                rank failed (see `checkpoint.write_checkpoint`)
+        """
+        self.C.sync()
+        write_checkpoint(self.C, self.E, path)
+        return self
+
+    @traced
     def head(self, n=10):
         """Distribute the first n elements to all ranks
         (useful for interactive debugging)
 
+        Same as `take(0, n)`.
+
         Returns:
             first n values, [elem]
         """
+        return self.take(0, n)
+
+    @traced
+    def take(self, i0, i1):
+        """Distribute elements i0 <= i < i1 to all ranks.
+
+        Global offsets come from one exscan of the local sizes,
+        so only the ranks holding the requested elements
+        contribute data to a single allgather.
+
+        Args:
+            i0: first global index
+            i1: end global index (exclusive)
+
+        Returns:
+            [elem]
+        """
+        self.C.sync()
+        # global index of this rank's first element
+        off = self.C.comm.exscan(len(self.E))
+        if off is None: # rank 0
+            off = 0
+        mine = self.E[max(0, i0-off) : max(0, i1-off)]
 
-        # create dfm with length of each rank
         ans = []
-        root = 0
-        while len(ans) < n:
-            if root >= self.C.procs:
-                break
-            data = None
-            if root == self.C.rank:
-                data = self.E[:min(len(self.E), n - len(ans))]
-            ans.extend( self.C.comm.bcast(data, root=root) )
-            root += 1
+        for x in self.C.comm.allgather(mine):
+            ans.extend(x)
         return ans
 
+    @traced
+    def sample(self, fraction, seed=None):
+        """Keep each element independently with probability `fraction`.
+
+        This is local (no communication).
+
+        Args:
+            fraction: probability of keeping each element
+            seed: random seed (combined with the rank,
+                  so ranks draw different streams)
+
+        Returns:
+            new DFM
+        """
+        rng = random.Random(None if seed is None else f"{seed}:{self.C.rank}")
+        return DFM(self.C, [e for e in self.E if rng.random() < fraction])
+
+    @traced
+    def takeSample(self, n, seed=None):
+        """Uniform random sample of n elements (without replacement),
+        distributed to all ranks.
+
+        Each rank draws a local sample of up to n elements,
+        then samples are merged pairwise in a fan-in reduction,
+        drawing the number kept from each side from a
+        hypergeometric distribution.  So, only O(n log P)
+        elements are sent.
+
+        Args:
+            n: sample size (fewer if the DFM is smaller)
+            seed: random seed
+
+        Returns:
+            [elem] (in random order)
+        """
+        self.C.sync()
+        rng = random.Random(None if seed is None else f"{seed}:{self.C.rank}")
+        def merge(a, b): # (population size, sample)
+            na, sa = a
+            nb, sb = b
+            k = min(n, na+nb)
+            ka = 0 # hypergeometric draw of the number taken from a
+            for i in range(k):
+                if rng.random()*(na+nb-i) < na-ka:
+                    ka += 1
+            return (na+nb, rng.sample(sa, ka) + rng.sample(sb, k-ka))
+
+        R = Reducer(None, (len(self.E), rng.sample(self.E, min(n, len(self.E)))),
+                    comb=merge)
+        ans = HierReducer(self.C, R, shared=False)()
+        if self.C.rank == 0: # shuffle once, so all ranks agree
+            ans = ans[1]
+            rng.shuffle(ans)
+        return self.C.comm.bcast(ans)
+
+    @traced
+    def takeOrdered(self, k, key=None):
+        """The k smallest elements, distributed to all ranks.
+
+        Each rank selects its k smallest elements (with a heap),
+        then these are merged in a fan-in reduction,
+        so only O(k log P) elements are sent.
+
+        Args:
+            k: number of elements
+            key: optional function of type = elem -> comparable
+
+        Returns:
+            [elem] in ascending order
+        """
+        self.C.sync()
+        def merge(a, b):
+            return heapq.nsmallest(k, heapq.merge(a, b, key=key), key=key)
+        R = Reducer(None, heapq.nsmallest(k, self.E, key=key), comb=merge)
+        ans = HierReducer(self.C, R, shared=False)()
+        return self.C.comm.bcast(ans)
+
+    @traced
+    def topk(self, k, key=None):
+        """The k largest elements, distributed to all ranks.
+
+        See `takeOrdered`.
+
+        Returns:
+            [elem] in descending order
+        """
+        self.C.sync()
+        def merge(a, b):
+            return heapq.nlargest(k, a+b, key=key)
+        R = Reducer(None, heapq.nlargest(k, self.E, key=key), comb=merge)
+        ans = HierReducer(self.C, R, shared=False)()
+        return self.C.comm.bcast(ans)
+
+    @traced
+    def sketch(self, S, key=None):
+        """Summarize all elements with a mergeable sketch
+        (see `mpi_list.sketch`).
+
+        Each rank updates S with its elements -- array elements
+        in one call each, and all other elements in one
+        call together -- then the sketches are merged
+        in a fan-in reduction.
+
+        Args:
+            S: empty sketch (configured the same way on all ranks)
+            key: optional function of type = elem -> value(s) to sketch
+
+        Returns:
+            merged sketch, on all ranks
+        """
+        self.C.sync()
+        vals = []
+        for e in self.E:
+            if key is not None:
+                e = key(e)
+            if np is not None and isinstance(e, np.ndarray):
+                S.update(e)
+            else:
+                vals.append(e)
+        if len(vals) > 0:
+            S.update(vals)
+        R = Reducer(None, S, comb=lambda a, b: a.merge(b))
+        ans = HierReducer(self.C, R, shared=False)()
+        return self.C.comm.bcast(ans)
+
+    def approxCountDistinct(self, p=14, key=None):
+        """Approximate number of distinct values (HyperLogLog).
+
+        Args:
+            p: log2 of the number of registers
+               (relative error is about 1.04/sqrt(2**p))
+            key: see `sketch`
+
+        Returns:
+            float, on all ranks
+        """
+        return self.sketch(HyperLogLog(p), key).count()
+
+    def approxQuantile(self, q, k=200, key=None):
+        """Approximate quantile(s) of numeric values.
+
+        Args:
+            q: float or list of floats in [0,1]
+            k: values held per level of the `QuantileSketch`
+            key: see `sketch`
+
+        Returns:
+            float (or np.ndarray for a list of q), on all ranks
+        """
+        return self.sketch(QuantileSketch(k), key).quantile(q)
+
+    @traced
     def repartition(self, llen, split, concat, N):
         """Repartition into N "equally distributed" items.
 
@@ -279,6 +927,13 @@ class DFM:
         The function ``concat`` will do the final join
         of all blocks composing each output element.
 
+        The communication schedule is cached on the Context
+        (see `Context.clear_plans`), keyed by all element lengths and N.
+        Repeating a repartition with the same layout reuses it,
+        and if the blocks are numpy arrays with unchanged
+        shapes, moves them with persistent MPI requests
+        instead of pickling.
+
         Args:
             llen: function of type = e -> int
                   returning the internal length of each element
@@ -297,57 +952,20 @@ class DFM:
             assert len(v) == len(idx), "Error: invalid split return value"
             return v
 
-        # cumulative sum of all lengths
-        plen = self.map(llen).scan(lambda a,b: a+b).E
-
-        # gather this directly, since the segments tell us the ranks
-        # owning each slice of segments
-        slen = self.C.comm.allgather( plen )
-        srank = [] # src rank for each segment
-        ssum  = [0] # global index starts for elements on ea. rank
-        start_local = 0
-        for i,o in enumerate(slen): # loop over ranks
-            if i < self.C.rank:
-                start_local += len(o)
-            srank.extend( [i]*len(o) )
-            ssum.extend( o )
-        #print(f"local for {self.C.rank} = {start_local}")
-
-        # target elem-lens on return (heavy elems at end)
-        tgt = list(reversed(even_spread(ssum[-1], N)))
-        # rank of output elems (extra elems at start)
-        orank = []
-        for i,n in enumerate(even_spread(N,self.C.procs)):
-            orank.extend( [i]*n )
-
-        seg = segments(ssum, cumsum(tgt))
+        # The schedule only depends on all element lengths
+        # and N, so it is cached by the Context (see `Plan`).
+        lens = self.C.comm.allgather( [llen(e) for e in self.E] )
+        P = self.C._plan(lens, N)
 
         local = []
-        sched = []
-        cur = None # use these to accumulate indices
-        loc = []   # to split current src elem, `cur`
-        for i,s in enumerate(seg):
-            ri = srank[s.src]
-            ro = orank[s.dst]
-            if ri == self.C.rank:
-                if cur is None:
-                    cur = s.src
-                elif cur != s.src:
-                    local.extend(run_split(self.E[cur-start_local], loc))
-                    loc = []
-                    cur = s.src
-                loc.append( (s.s0,s.s1) )
-
-                sched.append((i, ri, ro, s.dst))
-            elif ro == self.C.rank:
-                sched.append((i, ri, ro, s.dst))
-        if len(loc) > 0:
-            local.extend(run_split(self.E[cur-start_local], loc))
-
-        newE = send_items(self.C, local, sched)
+        for k, idx in P.splits:
+            local.extend(run_split(self.E[k], idx))
+
+        newE = P.run(self.C, local)
         return DFM(self.C, [concat(e) for e in newE])
 
-    def group(self, f, concat, N):
+    @traced
+    def group(self, f, concat, N, max_bytes=None, spill_dir=None):
         """Group elements into `N` partitions.
 
         Each element, `e`, is assumed to represent a collection
@@ -379,36 +997,511 @@ class DFM:
             concat: function of type = [e'] -> new elem
                    building the final output elements
             N: the number of output elements
+            max_bytes: if given, group out-of-core: received
+                   blocks beyond max_bytes (pickled size) are
+                   spilled to sorted run files, and the output
+                   elements are built lazily by merging them
+                   (E is a `spill.SpillList`)
+            spill_dir: directory for run files (preferably
+                   node-local, default: the system temp directory)
 
         Returns:
-            DFM of new elems
+            DFM of new elems, with part = IndexPartitioner(N).
+            Grouping that output again with the same N skips
+            all communication if every index produced is
+            already local.
 
         """
         dP = {}
         for e in self.E:
             f(e, dP)
-        ans = gather_partitions(self.C, dP, N)
+        part = IndexPartitioner(N)
+        if max_bytes is not None:
+            E = gather_spill(self.C, dP, N, concat, max_bytes, spill_dir)
+            return DFM(self.C, E, part)
+        if self.part == part and self._local_groups(dP, N):
+            # regrouping already-grouped data: no communication
+            ans = [list(dP[i]) for i in sorted(dP)]
+        else:
+            ans = gather_partitions(self.C, dP, N)
         del dP
-        return DFM(self.C, [concat(a) for a in ans])
+        return DFM(self.C, [concat(a) for a in ans], part)
+
+    @traced
+    def group_arrays(self, keyfn, N):
+        """Group rows of numeric arrays by integer key,
+        without per-row Python work.
+
+        Each element yields a key array and a value array
+        with one row per key.  Rows are bucketed by
+        destination rank with a stable argsort, moved
+        in one Alltoallv of raw buffers, and split
+        into one array per key.
+
+        Args:
+            keyfn: function of type = elem -> (keys, values)
+                   where keys is an integer array with 0 <= key < N,
+                   and values is an array with len(keys) rows
+                   (the same dtype and row shape on every rank,
+                   not of object dtype)
+            N: the number of output elements (keys)
+
+        Returns:
+            DFM of value arrays, one for each key in this
+            rank's block (as in `group`, but including empty
+            groups).  Rows with the same key are ordered by
+            source rank, then by their order on that rank.
+        """
+        return DFM(self.C, group_arrays(self.C, [keyfn(e) for e in self.E], N),
+                   IndexPartitioner(N))
+
+    def _local_groups(self, dP, N):
+        # Are all group indices, on all ranks, in the local block?
+        lo, hi = cumsum(even_spread(N, self.C.procs))[self.C.rank:self.C.rank+2]
+        ok = all(lo <= i < hi for i in dP)
+        return self.C.comm.allreduce(ok, op=self.C.MPI.LAND)
+
+    def _pair_part(self, part):
+        # partitioner to use for a key-based operation
+        if part is None:
+            if keyed(self.part):
+                return self.part
+            return HashPartitioner(self.C.procs)
+        if isinstance(part, int):
+            return HashPartitioner(part)
+        return part
+
+    @traced
+    def partitionBy(self, part=None):
+        """Move (key, value) pairs to the ranks owning their keys.
+
+        Args:
+            part: HashPartitioner or RangePartitioner
+                  (see `mpi_list.partition`), or an int, N,
+                  for HashPartitioner(N).  Defaults to the
+                  current key partitioning, if any,
+                  or else HashPartitioner(C.procs).
+
+        Returns:
+            DFM of the same pairs, partitioned by `part`
+            (self, if it already was)
+        """
+        part = self._pair_part(part)
+        if self.part == part:
+            return self
+        keys = [kv[0] for kv in self.E]
+        dP = {}
+        for kv, r in zip(self.E, part.ranks(keys, self.C.procs)):
+            dP.setdefault(int(r), []).append(kv)
+        ans = gather_partitions(self.C, dP, self.C.procs)
+        return DFM(self.C, ans[0] if len(ans) > 0 else [], part)
+
+    @traced
+    def reduceByKey(self, f, part=None):
+        """Reduce the values of (key, value) pairs with the same key.
+
+        Pairs are combined locally, then shuffled to
+        the ranks owning their keys (unless already partitioned
+        by `part`) and combined again.
+
+        Args:
+            f: associative function of type = value, value -> value
+            part: see `partitionBy`
+
+        Returns:
+            DFM of (key, reduced value) pairs, partitioned by `part`
+        """
+        part = self._pair_part(part)
+        pairs = self
+        if self.part != part:
+            pairs = DFM(self.C, list(_combine(self.E, f).items())) \
+                        .partitionBy(part)
+        return DFM(self.C, list(_combine(pairs.E, f).items()), part)
+
+    @traced
+    def groupByKey(self, part=None):
+        """Collect the values of (key, value) pairs with the same key.
+
+        Args:
+            part: see `partitionBy`
+
+        Returns:
+            DFM of (key, [value]) pairs, partitioned by `part`
+        """
+        part = self._pair_part(part)
+        grp = {}
+        for k, v in self.partitionBy(part).E:
+            grp.setdefault(k, []).append(v)
+        return DFM(self.C, list(grp.items()), part)
+
+    @traced
+    def join(self, other, part=None):
+        """Inner join of two DFMs of (key, value) pairs.
+
+        Sides already partitioned by `part` are not shuffled.
+
+        Args:
+            other: DFM of (key, w) pairs
+            part: see `partitionBy` -- defaults to the key
+                  partitioning of self or other, if any
+
+        Returns:
+            DFM of (key, (value, w)) pairs, partitioned by `part`
+        """
+        if part is None and not keyed(self.part) and keyed(other.part):
+            part = other.part
+        part = self._pair_part(part)
+        idx = {}
+        for k, w in other.partitionBy(part).E:
+            idx.setdefault(k, []).append(w)
+        ans = [ (k, (v, w)) for k, v in self.partitionBy(part).E
+                            for w in idx.get(k, ()) ]
+        return DFM(self.C, ans, part)
+
+def _combine(pairs, f):
+    # {key: value} reducing values with the same key
+    ans = {}
+    for k, v in pairs:
+        ans[k] = f(ans[k], v) if k in ans else v
+    return ans
+
+def _counted_gather(C, E, root, info):
+    # gather (allgather if root is None) over C,
+    # counting the bytes leaving and reaching this rank
+    if root is None:
+        lE = C.comm.allgather(E)
+    else:
+        lE = C.comm.gather(E, root=root)
+    if C.procs > 1 and root != C.rank:
+        count(C, info, "bytes_sent", E)
+    if root is None or root == C.rank:
+        for r, x in enumerate(lE):
+            if r != C.rank:
+                count(C, info, "bytes_recv", x)
+    return lE
+
+MAX_PLANS = 16 # repartition plans cached per Context
 
 class Context:
     """Global context
     
     The context is a convenient place to store MPI attributes.
+    All DFM operations are collective over `comm`, so a
+    Context built on a sub-communicator scopes its DFMs
+    to that subset of ranks.
 
     Attributes:
         rank:  rank of the current process (0, 1, ..., procs-1)
         procs: number of MPI ranks
-        comm:  MPI.COMM_WORLD
+        comm:  MPI communicator (MPI.COMM_WORLD by default)
+        serializer: how Python objects are sent between ranks --
+               "pkl5" (pickle protocol 5, sending array data
+               out-of-band without extra copies), "pickle",
+               or a compressor: "lz4", "zstd", "zlib" or "auto"
+               (see `mpi_list.serial`)
         MPI:   mpi4py's MPI module
+        auto_balance: if not None, filter and flatMap rebalance
+               their output whenever the largest rank holds
+               more than auto_balance times the mean
+               number of elements
 
     """
-    def __init__(self):
+    def __init__(self, comm=None, serializer="pkl5"):
         from mpi4py import MPI
-        self.comm = MPI.COMM_WORLD
+        if comm is None:
+            comm = MPI.COMM_WORLD
+        self.serializer = serializer
+        self.comm = wrap(comm, serializer)
         self.rank = self.comm.Get_rank()
         self.procs = self.comm.Get_size()
         self.MPI = MPI
+        self.hierarchical = True
+        self._topo = None  # (node, leaders), once computed
+        self._hier = False # not yet computed
+        self.accumulators = []
+        self.tracer = None
+        self.auto_balance = None
+        self.plans = {}
+        self._nbx = None   # sparse_exchange's [comm, round]
+
+    def hierarchy(self):
+        """Two-level topology: a shared-memory context for
+        the ranks on this node, plus a context connecting
+        the node leaders (node-local rank 0).
+
+        This is collective on the first call, and cached afterward.
+
+        The hierarchy is only usable when every node holds a
+        contiguous block of ranks (so that reductions
+        stay in rank order) and some node has more than one rank.
+        Setting `C.hierarchical = False` disables its use
+        in reductions and collect.
+
+        Returns:
+            (node, leaders) if usable, otherwise None.
+            `leaders` is None on ranks that are not node leaders.
+        """
+        if self._hier is not False:
+            return self._hier
+        node, leaders = self.topology()
+        lo = node.comm.allreduce(self.rank, op=self.MPI.MIN)
+        hi = node.comm.allreduce(self.rank, op=self.MPI.MAX)
+        ok = self.comm.allreduce(hi-lo+1 == node.procs, op=self.MPI.LAND)
+        big = self.comm.allreduce(node.procs, op=self.MPI.MAX) > 1
+        self._hier = (node, leaders) if ok and big else None
+        return self._hier
+
+    def topology(self):
+        """Node-local and node-leader contexts.
+
+        Like `hierarchy`, but always returns the pair,
+        without checking the rank layout.
+        Collective on the first call, and cached afterward.
+
+        Returns:
+            (node, leaders) -- `leaders` is None on ranks
+            that are not node leaders.
+        """
+        if self._topo is None:
+            node = self.split_shared()
+            leaders = self.split(0 if node.rank == 0 else None)
+            self._topo = (node, leaders)
+        return self._topo
+
+    def broadcast(self, obj, root=0):
+        """Share read-only data with every rank.
+
+        NumPy arrays are copied once into a shared-memory
+        segment on each node, and every rank gets a read-only
+        view of that segment.  Other objects are sent with
+        a regular (pickled) broadcast.
+
+        This is collective.
+
+        Example::
+
+            table = C.broadcast(np.load("table.npy") if C.rank == 0 else None)
+            dfm.map(lambda i: table.value[i])
+
+        Args:
+            obj: the value to share (only used on rank `root`)
+            root: rank holding the value
+
+        Returns:
+            Broadcast -- with the data in its `value` attribute.
+            Call its `free()` method (collectively) to release
+            the shared segment.
+        """
+        return Broadcast(self, obj, root)
+
+    def enable_trace(self):
+        """Start recording a timeline of DFM operations.
+
+        Every DFM method call is recorded along with its
+        local element counts.  Communication inside those calls
+        is recorded as nested "comm" events with the number
+        of bytes sent and received.
+
+        This is collective (ranks synchronize to
+        align their time origins).
+
+        Note:
+            Counting bytes pickles each message an extra
+            time, so tracing adds overhead to pickled transfers.
+        """
+        self.comm.Barrier()
+        self.tracer = Tracer(self.rank)
+        if self._topo is not None:
+            for c in self._topo:
+                if c is not None:
+                    c.tracer = self.tracer
+
+    def span(self, name, cat="comm", **args):
+        """Context manager recording a traced block
+        (does nothing if tracing is not enabled).
+
+        Yields a dictionary of event arguments that can be updated
+        inside the block.
+        """
+        if self.tracer is None:
+            return null_span()
+        return self.tracer.span(name, cat, **args)
+
+    def write_trace(self, fname, root=0):
+        """Write the merged timeline of all ranks to `fname`
+        (in Chrome trace-event JSON format).
+
+        This is collective.
+
+        Args:
+            fname: output file name (written by rank `root`)
+            root:  rank writing the file
+
+        Returns:
+            this rank's summary -- {name: {"count", "time",
+            "comm", "bytes_sent", "bytes_recv"}}
+        """
+        if self.tracer is None:
+            raise RuntimeError("write_trace: call enable_trace() first")
+        write_trace(self, fname, root)
+        return self.tracer.summary()
+
+    def accumulator(self, zero, op='sum'):
+        """Create a distributed accumulator.
+
+        Functions passed to map, filter, flatMap, etc.
+        may call `acc.add(x)` to update a local value.
+        Every DFM action (len, reduce, aggregate, collect, head)
+        first merges all live accumulators, using one
+        Allreduce for each (op, dtype) of numeric accumulators.
+
+        Call `acc.free()` (or use the accumulator in a `with`
+        block) once it is no longer needed, so later actions
+        stop merging it.
+
+        This (and free) must be called in the same order by all ranks.
+
+        Args:
+            zero: initial value (the identity of `op`)
+            op: one of 'sum', 'prod', 'min', 'max',
+                or an associative function of type = a, a -> a
+
+        Returns:
+            Accumulator
+        """
+        acc = Accumulator(zero, op, self)
+        self.accumulators.append(acc)
+        return acc
+
+    def sync(self):
+        """Merge all pending accumulators (collective).
+
+        Called automatically at the start of every action.
+        This communicates only while live (not yet freed)
+        accumulators exist.
+        """
+        if len(self.accumulators) > 0:
+            merge_all(self, self.accumulators)
+
+    def split(self, color, key=None):
+        """Split into independent contexts over disjoint rank groups.
+
+        This is collective over the current context.
+        Ranks passing the same `color` end up in the same
+        new context, ordered by `key` (defaults to the current rank).
+
+        Example::
+
+            C2 = C.split(C.rank % 2) # even and odd ranks
+            C2.iterates(10).len()    # only involves 1/2 the ranks
+
+        Args:
+            color: non-negative int selecting the new group
+                   (or None to opt out -- in which case None is returned)
+            key:   int used to order ranks within the new group
+
+        Returns:
+            Context over the new sub-communicator, or None
+        """
+        if key is None:
+            key = self.rank
+        if color is None:
+            color = self.MPI.UNDEFINED
+        comm = self.comm.Split(color, key)
+        if comm == self.MPI.COMM_NULL:
+            return None
+        return self._child(comm)
+
+    def split_shared(self):
+        """Split into node-local contexts (ranks sharing memory).
+
+        This is collective over the current context.
+
+        Returns:
+            Context over all ranks on the same shared-memory node.
+        """
+        comm = self.comm.Split_type(self.MPI.COMM_TYPE_SHARED, self.rank)
+        return self._child(comm)
+
+    def _plan(self, lens, N):
+        # Cached repartition Plan for this layout
+        # (all ranks look up the same keys, so
+        # they evict the same plans).
+        key = (N, tuple(tuple(o) for o in lens))
+        P = self.plans.pop(key, None)
+        if P is None:
+            P = Plan(self.rank, lens, N)
+            while len(self.plans) >= MAX_PLANS:
+                self.plans.pop(next(iter(self.plans))).free()
+        self.plans[key] = P # most recently used last
+        return P
+
+    def clear_plans(self):
+        """Drop all cached repartition plans,
+        freeing their persistent MPI requests.
+
+        This must be called by all ranks.
+        """
+        for P in self.plans.values():
+            P.free()
+        self.plans = {}
+
+    def autotune(self, path=None, force=False):
+        """Calibrate the message sizes used by chunked transfers
+        (see `mpi_list.tune`).
+
+        Ranks 0 and 1 (or the leader of a second node) run a short
+        ping-pong over message sizes from 8 B to 16 MiB.  The
+        results are cached on disk for this machine and MPI library,
+        so later calls only read the cache.  Until this is called,
+        conservative defaults are used.
+
+        This must be called by all ranks.
+
+        Args:
+            path: cache file (default: ~/.cache/mpi_list/tune-<key>.json)
+            force: measure again, even if the cache exists
+
+        Returns:
+            tune.Params -- the values now in use (the same on all ranks)
+        """
+        return tune.autotune(self, path, force)
+
+    def _child(self, comm):
+        # new Context sharing this one's settings
+        C = Context(comm, self.serializer)
+        C.tracer = self.tracer
+        return C
+
+    def stream(self, source, prefetch=True):
+        """Create a micro-batch Stream (see `mpi_list.stream`).
+
+        Args:
+            source: iterable of [elem] -- this rank's batches
+            prefetch: read the next batch on a background thread
+                      while the current one is processed
+
+        Returns:
+            Stream
+        """
+        return Stream(self, source, prefetch=prefetch)
+
+    def restore(self, path):
+        """Load a DFM saved by `DFM.checkpoint`.
+
+        The number of ranks may differ from the
+        one that wrote the checkpoint.  If it is the same,
+        every rank gets back its original elements,
+        otherwise the elements are spread evenly over ranks
+        (in their original order).
+
+        Args:
+            path: checkpoint directory
+
+        Returns:
+            DFM
+        """
+        return DFM(self, read_checkpoint(self, path))
 
     def iterates(self, n, robin=False):
         """Create a DFM from a sequence of numbers.
@@ -430,4 +1523,4 @@ class Context:
         elapsed = min(self.rank, extra) # extra elements prior to rank
         extra1 = self.rank < extra # do I have an extra element?
         i0 = blk*self.rank + elapsed
-        return DFM(self, list(range(i0, i0+blk+extra1)))
+        return DFM(self, list(range(i0, i0+blk+extra1)), BlockPartitioner())
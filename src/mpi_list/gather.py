@@ -1,4 +1,88 @@
-def gather_partitions(C, dP, N):
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .segment import even_spread, cumsum
+from .trace import count
+from .serial import wrap
+from . import tune
+
+NBX_TAG = 52 # and 53, on a private communicator
+SPARSE_FRAC = 0.25 # use sparse_exchange when all ranks send to
+                   # at most this fraction of ranks
+
+def sparse_exchange(C, sends):
+    """Send one object to each of a few ranks, and receive
+    from the (unknown) set of ranks sending to this one.
+
+    Uses non-blocking consensus (NBX, Hoefler et. al. 2010):
+    synchronous sends, then a non-blocking barrier entered once
+    they have all been matched.  Costs O(destinations + log procs)
+    instead of the O(procs) of a dense exchange.
+
+    Note:
+        This must be called by all ranks.
+
+    Args:
+        C: Context
+        sends: {dst rank: obj} (dst != C.rank)
+
+    Returns:
+        [(src rank, obj)] sorted by src
+    """
+    comm, tag = _nbx_comm(C)
+    with C.span("sparse_exchange") as info:
+        status = C.MPI.Status()
+        pending = []
+        for dst, x in sends.items():
+            count(C, info, "bytes_sent", x)
+            pending.append( comm.issend(x, dest=dst, tag=tag) )
+        recvd = []
+        done = None
+        while True:
+            msg = comm.improbe(source=C.MPI.ANY_SOURCE, tag=tag,
+                               status=status)
+            if msg is not None:
+                recvd.append( (status.Get_source(), msg.recv()) )
+                count(C, info, "bytes_recv", recvd[-1][1])
+                continue
+            if done is None:
+                pending = [r for r in pending if not r.test()[0]]
+                if len(pending) == 0:
+                    done = comm.Ibarrier()
+            elif done.Test():
+                break
+    recvd.sort(key=lambda x: x[0])
+    return recvd
+
+def _nbx_comm(C):
+    # Communicator and tag for the next sparse_exchange.
+    #
+    # A rank leaving the Ibarrier may start its next exchange
+    # while others still probe for this one, so consecutive
+    # exchanges alternate between two tags.  (A rank is at most
+    # one exchange ahead: it cannot pass the next Ibarrier until
+    # every rank has entered it.)  The duplicate communicator
+    # keeps other operations' messages out of the ANY_SOURCE probes.
+    if C._nbx is None:
+        C._nbx = [wrap(C.MPI.Intracomm.Dup(C.comm), C.serializer), 0]
+    C._nbx[1] ^= 1
+    return C._nbx[0], NBX_TAG + C._nbx[1]
+
+def dest_sets(C, dP, N):
+    # [[(seq, e')] going to each rank]
+    sets = [[] for i in range(C.procs)]
+    bs = (N+C.procs-1) // C.procs # max blk sz
+    bs0 = N//C.procs
+    for seq, p in dP.items():
+        j = seq // bs # lower bound on j
+        while seq >= (j+1)*bs0 + min(N % C.procs, j+1):
+            j += 1
+        sets[j].append( (seq,p) )
+    return sets
+
+def gather_partitions(C, dP, N, sparse=None):
     """Gather together all the elements whose
     target sequence number is in the current
     rank's domain (seq0 <= seq < seq1)
@@ -14,6 +98,9 @@ def gather_partitions(C, dP, N):
         C: Context
         dP: {seq : e'} from current rank
         N: Number of output elements
+        sparse: send with `sparse_exchange` instead of
+                one gather per rank?  (default: when every
+                rank sends to few others)
 
     Returns:
         result = [[e'] with a given sequence number]
@@ -22,22 +109,27 @@ def gather_partitions(C, dP, N):
         are sorted ascending, but not provided.
         Note: len(result) <= seq1 - seq0
     """
-    sets = [[] for i in range(C.procs)] # output sets going to each rank
-    bs = (N+C.procs-1) // C.procs # max blk sz
-    bs0 = N//C.procs
-    for seq, p in dP.items():
-        j = seq // bs # lower bound on j
-        while seq >= (j+1)*bs0 + min(N % C.procs, j+1):
-            j += 1
-        sets[j].append( (seq,p) )
+    sets = dest_sets(C, dP, N)
+    if sparse is None: # few destinations -> point-to-point
+        ndst = sum(1 for r, x in enumerate(sets) if len(x) > 0 and r != C.rank)
+        ndst = C.comm.allreduce(ndst, op=C.MPI.MAX)
+        sparse = ndst <= SPARSE_FRAC * C.procs
 
     out = [ sets[C.rank] ] # local data skips MPI
-    for root in range(C.procs):
-        if C.rank == root:
-            # ans : [ [(i,p) belonging to self] ]
-            out.extend( C.comm.gather([], root) )
-        else:
-            C.comm.gather(sets[root], root)
+    if sparse:
+        out.extend( x for src, x in sparse_exchange(C,
+                        { r: x for r, x in enumerate(sets)
+                               if len(x) > 0 and r != C.rank }) )
+    else:
+        with C.span("gather_partitions") as info:
+            for root in range(C.procs):
+                if C.rank == root:
+                    # ans : [ [(i,p) belonging to self] ]
+                    out.extend( C.comm.gather([], root) )
+                else:
+                    count(C, info, "bytes_sent", sets[root])
+                    C.comm.gather(sets[root], root)
+            count(C, info, "bytes_recv", out[1:])
 
     # re-assemble local partitions
     ans = []
@@ -70,12 +162,143 @@ def gather_partitions(C, dP, N):
 
     return grps
 
-def send_chunks(comm, lst, dst, tag, max_elems=100000):
+def group_arrays(C, kv, N):
+    """Group array rows by key (see `DFM.group_arrays`).
+
+    Note:
+        This must be called by all ranks.
+
+    Args:
+        C: Context
+        kv: [(keys, values)] from current rank
+        N: number of keys
+
+    Returns:
+        [values for each key in the current rank's block]
+    """
+    MPI = C.MPI
+    keys = [np.asarray(k, dtype=np.int64).reshape(-1) for k, v in kv]
+    vals = [np.asarray(v) for k, v in kv]
+    for k, v in zip(keys, vals):
+        assert len(k) == len(v), "group_arrays: len(keys) != len(values)"
+
+    # agree on the row type (ranks may have no elements)
+    spec = None
+    if len(vals) > 0:
+        spec = (vals[0].dtype.str, vals[0].shape[1:])
+    specs = [x for x in C.comm.allgather(spec) if x is not None]
+    assert all(x == specs[0] for x in specs), \
+            "group_arrays: values differ in dtype or row shape"
+    dtype, row = specs[0] if len(specs) > 0 else ("<f8", ())
+    dtype = np.dtype(dtype)
+    assert not dtype.hasobject, "group_arrays: values must not be objects"
+
+    if len(vals) > 0:
+        keys = np.concatenate(keys)
+        vals = np.concatenate([v.astype(dtype, copy=False) for v in vals])
+    else:
+        keys = np.zeros(0, dtype=np.int64)
+        vals = np.zeros((0,)+row, dtype=dtype)
+    assert len(keys) == 0 or (keys.min() >= 0 and keys.max() < N), \
+            "group_arrays: keys must be in [0,N)"
+
+    bounds = np.array(cumsum(even_spread(N, C.procs)))
+    lo, hi = int(bounds[C.rank]), int(bounds[C.rank+1])
+    # sorting by key also sorts by destination rank
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    vals = np.ascontiguousarray(vals[order])
+    dest = np.searchsorted(bounds, keys, side="right") - 1
+    scount = np.bincount(dest, minlength=C.procs).astype(np.int64)
+
+    with C.span("group_arrays") as info:
+        rcount = np.zeros(C.procs, dtype=np.int64)
+        C.comm.Alltoall(scount, rcount)
+        sdispl = np.concatenate([[0], np.cumsum(scount)[:-1]])
+        rdispl = np.concatenate([[0], np.cumsum(rcount)[:-1]])
+
+        rkeys = np.empty(int(rcount.sum()), dtype=np.int64)
+        C.comm.Alltoallv([keys, scount, sdispl, MPI.INT64_T],
+                         [rkeys, rcount, rdispl, MPI.INT64_T])
+
+        rsz = dtype.itemsize * int(np.prod(row, dtype=np.int64))
+        rvals = np.empty((len(rkeys),)+row, dtype=dtype)
+        C.comm.Alltoallv([vals.reshape(-1).view(np.uint8),
+                          scount*rsz, sdispl*rsz, MPI.BYTE],
+                         [rvals.reshape(-1).view(np.uint8),
+                          rcount*rsz, rdispl*rsz, MPI.BYTE])
+        info["bytes_sent"] = int(scount.sum() - scount[C.rank])*(8+rsz)
+        info["bytes_recv"] = int(rcount.sum() - rcount[C.rank])*(8+rsz)
+
+    # received chunks are in source rank order
+    order = np.argsort(rkeys, kind="stable")
+    rvals = rvals[order]
+    counts = np.bincount(rkeys - lo, minlength=hi-lo)
+    return np.split(rvals, np.cumsum(counts)[:-1]) if hi > lo else []
+
+PULL_TAG = 54
+CHUNK_TAG = 55
+
+def serve_chunks(C, E, root, chunk):
+    # Send chunks of E to root, one per request
+    # (see `pull_chunks`), until E is done or root says stop.
+    n = len(E) if chunk is None else chunk
+    i = 0
+    with C.span("serve_chunks") as info:
+        while C.comm.recv(source=root, tag=PULL_TAG):
+            x = E[i:i+max(n, 1)]
+            i += len(x)
+            count(C, info, "bytes_sent", x)
+            C.comm.send( (x, i < len(E)), dest=root, tag=CHUNK_TAG)
+            if i >= len(E):
+                break
+
+def pull_chunks(C, E, root, chunk):
+    """Iterate over elements from all ranks, in rank order,
+    requesting chunks from each rank in turn.
+
+    The other ranks must call `serve_chunks`.
+    Closing the iterator early tells all ranks to stop.
+    """
+    pending = None # rank with an outstanding request
+    done = set()   # ranks that are finished
+    try:
+        for r in range(C.procs):
+            if r == root:
+                done.add(r)
+                yield from E
+                continue
+            C.comm.send(True, dest=r, tag=PULL_TAG)
+            pending = r
+            more = True
+            while more:
+                x, more = C.comm.recv(source=r, tag=CHUNK_TAG)
+                pending = None
+                if more: # overlap the next transfer
+                    C.comm.send(True, dest=r, tag=PULL_TAG)
+                    pending = r
+                else:
+                    done.add(r)
+                yield from x
+    finally:
+        if pending is not None: # complete the outstanding reply
+            x, more = C.comm.recv(source=pending, tag=CHUNK_TAG)
+            if not more:
+                done.add(pending)
+        for r in range(C.procs):
+            if r not in done:
+                C.comm.send(False, dest=r, tag=PULL_TAG)
+
+def send_chunks(comm, lst, dst, tag, max_elems=None):
+    if max_elems is None:
+        max_elems = tune.params.max_elems
     for i,n in enumerate(range(0, len(lst), max_elems)):
         m = min(n+max_elems, len(lst))
         comm.send(lst[n:m], dest=dst, tag=tag+100*i)
 
-def recv_chunks(comm, lst, off, src, tag, max_elems=100000):
+def recv_chunks(comm, lst, off, src, tag, max_elems=None):
+    if max_elems is None:
+        max_elems = tune.params.max_elems
     for i,n in enumerate(range(off, len(lst), max_elems)):
         m = min(n+max_elems, len(lst))
         lst[n:m] = comm.recv(source=src, tag=tag+100*i)
@@ -91,6 +314,10 @@ def send_items(C, items, sched):
     Returns:
         [ [items received with idx] over all idx-s ]
     """
+    with C.span("send_items") as info:
+        return _send_items(C, items, sched, info)
+
+def _send_items(C, items, sched, info):
     i = 0
     sends = []
     recvs = [] # nested list of recv-s, grouped by idx
@@ -114,11 +341,14 @@ def send_items(C, items, sched):
                 req = (False, items[i])
                 cidx, dgrp = accum_recv(req, cidx, idx, dgrp, recvs)
             else:
+                count(C, info, "bytes_sent", items[i])
                 req = C.comm.isend(items[i], dest=dst, tag=tag)
                 sends.append(req)
             i += 1
         elif dst == C.rank:
-            req = (True, C.comm.irecv(source=src, tag=tag))
+            # Receives are completed below, after all sends are posted.
+            # (pkl5 communicators do not support irecv.)
+            req = (True, (src, tag))
             cidx, dgrp = accum_recv(req, cidx, idx, dgrp, recvs)
     if len(dgrp) > 0:
         recvs.append(dgrp)
@@ -129,7 +359,8 @@ def send_items(C, items, sched):
         v = []
         for net, r in dgrp:
             if net:
-                v.append( r.wait() )
+                v.append( C.comm.recv(source=r[0], tag=r[1]) )
+                count(C, info, "bytes_recv", v[-1])
             else:
                 v.append( r )
         ans.append(v)
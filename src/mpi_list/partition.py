@@ -0,0 +1,103 @@
+# Partitioners: how the elements of a DFM are laid out over ranks.
+#
+# A DFM's `part` attribute records what is known about its layout
+# (None if nothing is known).  Key-based operations
+# (DFM.partitionBy, reduceByKey, groupByKey, join) look at it
+# to skip shuffles when the data is already where it needs to be.
+#
+# Hash and range partitioners apply to (key, value) pairs.
+# Any partitioner except BlockPartitioner survives removing
+# elements (DFM.filter).
+from bisect import bisect_right
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .segment import even_spread, cumsum
+from .sketch import hash64
+
+class BlockPartitioner:
+    """Elements are spread evenly over ranks, in order
+    (the layout of `Context.iterates`).
+    """
+    def __eq__(self, other):
+        return type(other) is BlockPartitioner
+
+    def __repr__(self):
+        return "BlockPartitioner()"
+
+class HashPartitioner:
+    """Pair (k, v) belongs to block hash(k) % N,
+    and blocks are spread evenly over ranks, in order
+    (as in `gather_partitions`).
+
+    The hash (see `sketch.hash64`) is the same on every rank.
+
+    Args:
+        N: number of blocks
+    """
+    def __init__(self, N):
+        self.N = N
+
+    def ranks(self, keys, procs):
+        """Rank owning each key.
+
+        Returns:
+            [int]
+        """
+        if len(keys) == 0:
+            return []
+        blk = hash64(keys) % np.uint64(self.N)
+        bounds = np.array(cumsum(even_spread(self.N, procs)))
+        return list(np.searchsorted(bounds, blk.astype(np.int64),
+                                    side="right") - 1)
+
+    def __eq__(self, other):
+        return type(other) is HashPartitioner and other.N == self.N
+
+    def __repr__(self):
+        return f"HashPartitioner({self.N})"
+
+class IndexPartitioner:
+    """Output of `DFM.group(f, concat, N)`: the elements on
+    each rank hold the group indices 0 <= i < N in that rank's
+    block (blocks are spread evenly over ranks, in order).
+
+    Args:
+        N: number of groups
+    """
+    def __init__(self, N):
+        self.N = N
+
+    def __eq__(self, other):
+        return type(other) is IndexPartitioner and other.N == self.N
+
+    def __repr__(self):
+        return f"IndexPartitioner({self.N})"
+
+class RangePartitioner:
+    """Rank r holds keys k with splitters[r-1] <= k < splitters[r].
+
+    Args:
+        splitters: ascending list of procs-1 keys
+    """
+    def __init__(self, splitters):
+        self.splitters = list(splitters)
+
+    def ranks(self, keys, procs):
+        assert len(self.splitters) == procs-1, \
+                "RangePartitioner: wrong number of splitters"
+        return [bisect_right(self.splitters, k) for k in keys]
+
+    def __eq__(self, other):
+        return type(other) is RangePartitioner \
+                and other.splitters == self.splitters
+
+    def __repr__(self):
+        return f"RangePartitioner({self.splitters})"
+
+def keyed(part):
+    # Does `part` place (key, value) pairs by key?
+    return isinstance(part, (HashPartitioner, RangePartitioner))
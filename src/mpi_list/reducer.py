@@ -5,19 +5,31 @@ try:
 except ImportError:
     np = None
 
+from .trace import count
+from . import tune
+
 # fn may modify and return its first argument
 # this means the `zero` input may be modified!
 # At the end of the reduction, `data` will hold the answer.
+#
+# `fn` accumulates local elements (__call__), and
+# `comb` merges accumulated values from other ranks (merge).
+# They are the same function unless `comb` is given.
 class Reducer:
-    def __init__(self, fn, zero):
-        self.fn = fn      #  *a,a -> a
+    def __init__(self, fn, zero, comb=None):
+        self.fn = fn      #  *a,e -> a
+        self.comb = fn if comb is None else comb # *a,a -> a
         self.data = zero  #  a
 
     def __call__(self, data2):
         self.data = self.fn(self.data, data2)
 
+    def merge(self, data2):
+        self.data = self.comb(self.data, data2)
+
 class CommReducer:
     def __init__(self, C, R):
+        self.C = C
         self.comm = C.comm
         self.rank = C.rank
         self.procs = C.procs
@@ -48,35 +60,113 @@ class CommReducer:
 
         return self.R.data
 
+    def fast(self):
+        # Send as raw bytes? (not possible for object arrays,
+        # and slower than pickling for small ones)
+        return np is not None and isinstance(self.R.data, np.ndarray) \
+                    and not self.R.data.dtype.hasobject \
+                    and self.R.data.nbytes >= tune.params.pickle_max
+
     def recv(self, j, lev):
-        if np is not None and isinstance(self.R.data, np.ndarray):
-            return self.fast_recv(j, lev)
-        self.R( self.comm.recv(source=j, tag=lev) )
+        if self.fast():
+            with self.C.span("reduce_recv", bytes_recv=self.R.data.nbytes):
+                return self.fast_recv(j, lev)
+        with self.C.span("reduce_recv") as info:
+            x = self.comm.recv(source=j, tag=lev)
+            count(self.C, info, "bytes_recv", x)
+        self.R.merge(x)
 
+    # Messages are at most tune.params.chunk bytes
+    # (MPI's nbytes is stored in an int!).  All chunks
+    # share one tag, since MPI keeps them in order.
     def fast_recv(self, j, lev):
-        len1 = (1<<30) - 1
-        nchunk = (self.R.data.nbytes + len1) >> 30
+        nbytes = self.R.data.nbytes
+        chunk = tune.params.chunk
 
-        dst = bytearray(self.R.data.nbytes) # MPI's nbytes is stored in an int!
+        dst = bytearray(nbytes)
         obj = memoryview(dst)
-        for k in range(nchunk):
-            end = min((k+1)<<30, self.R.data.nbytes)
-            self.comm.Recv([obj[k<<30 : end], end-(k<<30), self.MPI.BYTE], source=j, tag=100*lev+k)
-        #self.comm.Recv([dst, self.R.data.nbytes, MPI.BYTE], source=j, tag=lev)
-        self.R( np.frombuffer(dst, dtype=self.R.data.dtype) )
+        for k in range(0, nbytes, chunk):
+            end = min(k+chunk, nbytes)
+            self.comm.Recv([obj[k:end], end-k, self.MPI.BYTE], source=j, tag=lev)
+        self.R.merge( np.frombuffer(dst, dtype=self.R.data.dtype) )
 
     def send(self, i, lev):
-        if np is not None and isinstance(self.R.data, np.ndarray):
-            return self.fast_send(i, lev)
-        self.comm.send(self.R.data, dest=i, tag=lev)
+        if self.fast():
+            with self.C.span("reduce_send", bytes_sent=self.R.data.nbytes):
+                return self.fast_send(i, lev)
+        with self.C.span("reduce_send") as info:
+            count(self.C, info, "bytes_sent", self.R.data)
+            self.comm.send(self.R.data, dest=i, tag=lev)
 
     def fast_send(self, i, lev):
-        len1 = (1<<30) - 1
-        nchunk = (self.R.data.nbytes + len1) >> 30
+        nbytes = self.R.data.nbytes
+        chunk = tune.params.chunk
 
         obj = self.R.data.tobytes()
-        for k in range(nchunk):
-            end = min((k+1)<<30, self.R.data.nbytes)
-            self.comm.Send([obj[k<<30 : end], end-(k<<30), self.MPI.BYTE], dest=i, tag=100*lev+k)
-        #self.comm.Send([obj, self.R.data.nbytes, MPI.BYTE], dest=i, tag=lev)
+        for k in range(0, nbytes, chunk):
+            end = min(k+chunk, nbytes)
+            self.comm.Send([obj[k:end], end-k, self.MPI.BYTE], dest=i, tag=lev)
+
+
+class HierReducer:
+    # Two-level reduction following C.hierarchy():
+    # first combine the ranks on each node, then
+    # reduce over the node leaders.
+    #
+    # When every rank on a node holds an ndarray of the
+    # same shape and type, the on-node phase goes through
+    # an MPI shared window, so the node leader reads
+    # the other ranks' data in-place (no messages).
+    # Checking for this costs an allgather over the node,
+    # so callers knowing the result is not an array
+    # (on every rank) should pass shared=False.
+    def __init__(self, C, R, shared=None):
+        self.C = C
+        self.R = R
+        self.shared = shared
+
+    def __call__(self):
+        H = None
+        if self.C.hierarchical:
+            H = self.C.hierarchy()
+        if H is None:
+            return CommReducer(self.C, self.R)()
+
+        node, leaders = H
+        if self.shared is not False and self.shareable(node):
+            self.shared_reduce(node)
+        else:
+            CommReducer(node, self.R)()
+        if leaders is not None:
+            CommReducer(leaders, self.R)()
+        return self.R.data
+
+    def shareable(self, node):
+        # Do all ranks on the node hold matching arrays?
+        desc = None
+        if np is not None and isinstance(self.R.data, np.ndarray) \
+                          and not self.R.data.dtype.hasobject:
+            desc = (self.R.data.shape, self.R.data.dtype.str)
+        descs = node.comm.allgather(desc)
+        return desc is not None and all(d == desc for d in descs)
+
+    def shared_reduce(self, node):
+        data = self.R.data
+        win = node.MPI.Win.Allocate_shared(data.nbytes, 1, comm=node.comm)
+        def view(r):
+            buf, _ = win.Shared_query(r)
+            return np.frombuffer(buf, dtype=data.dtype,
+                                 count=data.size).reshape(data.shape)
 
+        win.Fence()
+        view(node.rank)[...] = data
+        win.Fence()
+        if node.rank == 0:
+            views = [view(r) for r in range(1, node.procs)]
+            for v in views:
+                self.R.merge(v)
+            # don't hand out pointers into the window
+            if any(np.may_share_memory(self.R.data, v) for v in views):
+                self.R.data = self.R.data.copy()
+        win.Fence()
+        win.Free()
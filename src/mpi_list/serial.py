@@ -0,0 +1,186 @@
+# Serialization of Python objects sent between ranks.
+#
+# "pkl5" (the default) uses mpi4py's pickle protocol 5
+# communicator, which sends buffers held by objects
+# (e.g. numpy arrays) out-of-band, as separate raw messages
+# instead of copying them into the pickle stream.
+#
+# A compressor name ("lz4", "zstd", "zlib" or "auto")
+# pickles each object, compresses the result,
+# and sends the compressed bytes out-of-band.
+# This trades CPU time for bandwidth on slow links.
+#
+# "pickle" uses mpi4py's standard (in-band) pickling.
+import pickle
+
+from mpi4py import MPI
+try:
+    from mpi4py.util import pkl5
+except ImportError:
+    pkl5 = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def _zlib():
+    import zlib
+    return (lambda b: zlib.compress(b, 1)), zlib.decompress
+
+def _lz4():
+    import lz4.frame
+    return lz4.frame.compress, lz4.frame.decompress
+
+def _zstd():
+    import zstandard
+    c = zstandard.ZstdCompressor()
+    d = zstandard.ZstdDecompressor()
+    return c.compress, d.decompress
+
+compressors = { "lz4": _lz4, "zstd": _zstd, "zlib": _zlib }
+
+def compressor(name):
+    """Look up a (compress, decompress) function pair.
+
+    Args:
+        name: "lz4", "zstd", "zlib", or "auto"
+              ("auto" picks the first one installed,
+              in that order)
+
+    Returns:
+        (compress, decompress) : bytes -> bytes
+    """
+    if name != "auto":
+        return compressors[name]()
+    for name in ["lz4", "zstd"]:
+        try:
+            return compressors[name]()
+        except ImportError:
+            pass
+    return _zlib()
+
+def wrap(comm, serializer="pkl5"):
+    """Return a view of comm that sends Python objects
+    using the named serializer.
+
+    The result is still an MPI communicator (uppercase,
+    buffer-based methods are unchanged).
+
+    Args:
+        comm: MPI.Intracomm
+        serializer: "pkl5", "pickle", or a compressor name
+                    (see `compressor`)
+
+    Returns:
+        MPI.Intracomm
+    """
+    if serializer == "pickle" or pkl5 is None:
+        return comm
+    if serializer == "pkl5":
+        return pkl5.Intracomm(comm)
+    comp, decomp = compressor(serializer)
+    Z = ZComm(comm)
+    Z.comp = comp
+    Z.decomp = decomp
+    return Z
+
+class ZRequest:
+    # Request decompressing its message on completion.
+    def __init__(self, comm, req):
+        self.comm = comm
+        self.req = req
+
+    def wait(self, status=None):
+        return self.comm.unpack( self.req.wait(status) )
+
+    def test(self, status=None):
+        flag, x = self.req.test(status)
+        if flag:
+            x = self.comm.unpack(x)
+        return flag, x
+
+class ZMessage:
+    # Matched message decompressing on receive.
+    def __init__(self, comm, msg):
+        self.comm = comm
+        self.msg = msg
+
+    def recv(self, status=None):
+        return self.comm.unpack( self.msg.recv(status) )
+
+    def irecv(self):
+        return ZRequest(self.comm, self.msg.irecv())
+
+def _unpack_all(comm, xs):
+    if xs is None:
+        return None
+    return [comm.unpack(x) for x in xs]
+
+if pkl5 is not None:
+    class ZComm(pkl5.Intracomm):
+        # Communicator compressing every pickled message.
+        #
+        # Like pkl5, irecv is unsupported -- use recv,
+        # or mprobe/improbe and the returned message's irecv.
+        def pack(self, obj):
+            data = self.comp( pickle.dumps(obj, pickle.HIGHEST_PROTOCOL) )
+            return np.frombuffer(data, dtype=np.uint8)
+
+        def unpack(self, data):
+            return pickle.loads( self.decomp(data) )
+
+        def send(self, obj, dest, tag=0):
+            return super().send(self.pack(obj), dest, tag)
+
+        def bsend(self, obj, dest, tag=0):
+            return super().bsend(self.pack(obj), dest, tag)
+
+        def ssend(self, obj, dest, tag=0):
+            return super().ssend(self.pack(obj), dest, tag)
+
+        def isend(self, obj, dest, tag=0):
+            return super().isend(self.pack(obj), dest, tag)
+
+        def ibsend(self, obj, dest, tag=0):
+            return super().ibsend(self.pack(obj), dest, tag)
+
+        def issend(self, obj, dest, tag=0):
+            return super().issend(self.pack(obj), dest, tag)
+
+        def recv(self, buf=None, source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG,
+                 status=None):
+            return self.unpack( super().recv(buf, source, tag, status) )
+
+        def sendrecv(self, sendobj, dest, sendtag=0, recvbuf=None,
+                     source=MPI.ANY_SOURCE, recvtag=MPI.ANY_TAG, status=None):
+            return self.unpack( super().sendrecv(self.pack(sendobj), dest,
+                                sendtag, recvbuf, source, recvtag, status) )
+
+        def mprobe(self, source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=None):
+            return ZMessage(self, super().mprobe(source, tag, status))
+
+        def improbe(self, source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=None):
+            msg = super().improbe(source, tag, status)
+            if msg is None:
+                return None
+            return ZMessage(self, msg)
+
+        def bcast(self, obj, root=0):
+            data = self.pack(obj) if self.Get_rank() == root else None
+            return self.unpack( super().bcast(data, root) )
+
+        def gather(self, sendobj, root=0):
+            return _unpack_all(self, super().gather(self.pack(sendobj), root))
+
+        def scatter(self, sendobj, root=0):
+            if self.Get_rank() == root:
+                sendobj = [self.pack(x) for x in sendobj]
+            return self.unpack( super().scatter(sendobj, root) )
+
+        def allgather(self, sendobj):
+            return _unpack_all(self, super().allgather(self.pack(sendobj)))
+
+        def alltoall(self, sendobj):
+            return _unpack_all(self,
+                    super().alltoall([self.pack(x) for x in sendobj]))
@@ -0,0 +1,89 @@
+# Node-level shared memory segments.
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from . import tune
+
+class Broadcast:
+    """Read-only value available on every rank.
+
+    Created by `Context.broadcast`.  NumPy arrays live in an
+    MPI shared window allocated once per node, so
+    all ranks on a node share a single copy.
+
+    Attributes:
+        value: the broadcast data (read-only ndarray view, or
+               an ordinary object for non-array data)
+
+    """
+    def __init__(self, C, obj, root=0):
+        self.win = None
+
+        # Object arrays hold pointers, so they are pickled instead.
+        desc = None
+        src = None
+        if C.rank == root and np is not None \
+                          and isinstance(obj, np.ndarray) \
+                          and not obj.dtype.hasobject:
+            desc = (obj.shape, obj.dtype.str)
+            src = np.ascontiguousarray(obj).reshape(-1).view(np.uint8)
+        desc = C.comm.bcast(desc, root=root)
+        if desc is None:
+            self.value = C.comm.bcast(obj, root=root)
+            return
+
+        shape, dtype = desc
+        dtype = np.dtype(dtype)
+        nbytes = dtype.itemsize
+        for n in shape:
+            nbytes *= n
+
+        node, leaders = C.topology()
+        # whole segment is owned by the node leader
+        size = nbytes if node.rank == 0 else 0
+        self.win = C.MPI.Win.Allocate_shared(size, 1, comm=node.comm)
+        try:
+            self.value = self.fill(C, node, leaders, src, nbytes,
+                                   dtype, shape, root)
+        except BaseException:
+            self.free()
+            raise
+
+    def fill(self, C, node, leaders, src, nbytes, dtype, shape, root):
+        # Copy the root's data into every node's segment.
+        buf, _ = self.win.Shared_query(0)
+        buf = memoryview(buf).cast('B')[:nbytes]
+
+        # leader index of the root's node
+        lroot = node.comm.bcast(
+                    leaders.rank if leaders is not None else None, root=0)
+        lroot = C.comm.bcast(lroot, root=root)
+
+        self.win.Fence()
+        if C.rank == root:
+            buf[:] = memoryview(src)
+        self.win.Fence()
+        if leaders is not None:
+            chunk = tune.params.chunk # the same on all ranks
+            for k in range(0, nbytes, chunk):
+                end = min(k+chunk, nbytes)
+                leaders.comm.Bcast([buf[k:end], end-k, C.MPI.BYTE],
+                                   root=lroot)
+        self.win.Fence()
+
+        value = np.frombuffer(buf, dtype=dtype).reshape(shape)
+        value.setflags(write=False)
+        return value
+
+    def free(self):
+        """Release the shared segment (collective over the node).
+
+        `value` must not be used afterward.
+        """
+        self.value = None
+        if self.win is not None:
+            self.win.Free()
+            self.win = None
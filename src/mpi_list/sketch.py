@@ -0,0 +1,246 @@
+# Mergeable sketches for approximate summaries of a DFM.
+#
+# Each sketch has a fixed (small) size, is built in vectorized
+# passes over its input with `update`, and combines with another
+# sketch of the same configuration using `merge`.  So, they
+# can be reduced with the same fan-in tree as DFM.reduce
+# (see DFM.sketch).
+import hashlib
+import pickle
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def _mix64(z):
+    # splitmix64 finalizer (uint64 arithmetic wraps)
+    z = z + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+def _obj_hash(x):
+    # 64-bit input to _mix64 for one value --
+    # numbers match the vectorized path in hash64
+    if isinstance(x, (int, np.integer)) and -2**63 <= x < 2**64:
+        return int(x) & 0xFFFFFFFFFFFFFFFF
+    if isinstance(x, (float, np.floating)):
+        return int(np.array([x + 0.0]).view(np.uint64)[0])
+    if isinstance(x, str):
+        b = x.encode()
+    elif isinstance(x, bytes):
+        b = x
+    else:
+        b = pickle.dumps(x, protocol=4)
+    return int.from_bytes(hashlib.blake2b(b, digest_size=8).digest(), "little")
+
+def _as_array(values):
+    # 1D array with one entry per value (numeric if possible)
+    if isinstance(values, np.ndarray):
+        return values
+    values = list(values)
+    try:
+        if all(isinstance(x, (int, np.integer)) for x in values):
+            return np.asarray(values, dtype=np.int64)
+        if all(isinstance(x, (float, np.floating)) for x in values):
+            return np.asarray(values, dtype=np.float64)
+    except OverflowError:
+        pass
+    a = np.empty(len(values), dtype=object)
+    for i, x in enumerate(values):
+        a[i] = x
+    return a
+
+def hash64(values, seed=0):
+    """Hash values to uint64, identically on every rank.
+
+    Unlike Python's `hash`, the result does not depend on
+    the process (str hashes are randomized per process).
+    Numeric arrays are hashed with vectorized integer mixing,
+    other values one at a time.  A value hashes the same way
+    whatever else is in `values` (but 3 and 3.0 differ).
+
+    Args:
+        values: array-like of values
+        seed: int selecting an independent hash function
+
+    Returns:
+        np.ndarray of np.uint64
+    """
+    with np.errstate(over="ignore"):
+        a = _as_array(values)
+        if a.dtype.kind in "biu":
+            h = a.astype(np.int64).view(np.uint64).ravel()
+        elif a.dtype.kind == "f":
+            h = (a.astype(np.float64).ravel() + 0.0).view(np.uint64) # -0.0 == 0.0
+        else:
+            h = np.fromiter((_obj_hash(x) for x in a.ravel()),
+                            dtype=np.uint64, count=a.size)
+        return _mix64(h ^ _mix64(np.uint64(seed)))
+
+def stable_hash(x):
+    """Hash a single value to a non-negative int, identically on every rank.
+    """
+    return int(hash64([x])[0])
+
+def _bit_length(x):
+    # number of bits needed to represent each uint64 in x
+    n = np.zeros(x.shape, dtype=np.int64)
+    x = x.copy()
+    for s in (32, 16, 8, 4, 2, 1):
+        big = x >= (np.uint64(1) << np.uint64(s))
+        n[big] += s
+        x[big] >>= np.uint64(s)
+    return n + (x > 0)
+
+class HyperLogLog:
+    """Approximate count of distinct values.
+
+    Relative error is about 1.04/sqrt(2**p).
+
+    Args:
+        p: log2 of the number of registers (4 <= p <= 18)
+    """
+    def __init__(self, p=14):
+        assert 4 <= p <= 18, "HyperLogLog: p must be in [4,18]"
+        self.p = p
+        self.reg = np.zeros(1 << p, dtype=np.uint8)
+
+    def update(self, values):
+        h = hash64(values)
+        if len(h) == 0:
+            return self
+        q = 64 - self.p
+        idx = (h >> np.uint64(q)).astype(np.int64)
+        rest = h & ((np.uint64(1) << np.uint64(q)) - np.uint64(1))
+        rho = (q + 1 - _bit_length(rest)).astype(np.uint8)
+        np.maximum.at(self.reg, idx, rho)
+        return self
+
+    def merge(self, other):
+        assert self.p == other.p, "HyperLogLog: mismatched p"
+        np.maximum(self.reg, other.reg, out=self.reg)
+        return self
+
+    def count(self):
+        """Estimated number of distinct values."""
+        m = len(self.reg)
+        alpha = 0.7213 / (1.0 + 1.079/m)
+        est = alpha * m * m / np.sum(np.ldexp(1.0, -self.reg.astype(np.int64)))
+        zeros = int(np.count_nonzero(self.reg == 0))
+        if est <= 2.5*m and zeros > 0: # linear counting
+            est = m * np.log(m / zeros)
+        return float(est)
+
+class QuantileSketch:
+    """Approximate quantiles (a KLL-style compactor sketch).
+
+    Each level holds at most k values, and values at level h
+    stand for 2**h inputs.  When a level overflows, it is sorted
+    and every other value (from a random offset) moves up a level.
+    Rank error is roughly O(log(n/k) / k).
+
+    Args:
+        k: values held per level
+        seed: seed for the compaction offsets
+    """
+    def __init__(self, k=200, seed=None):
+        self.k = k
+        self.levels = []
+        self.n = 0
+        self.rng = np.random.default_rng(seed)
+
+    def update(self, values):
+        v = np.asarray(values, dtype=np.float64).ravel()
+        if len(v) == 0:
+            return self
+        self.n += len(v)
+        self._add(0, v)
+        self.compress()
+        return self
+
+    def _add(self, h, v):
+        while len(self.levels) <= h:
+            self.levels.append(np.zeros(0))
+        self.levels[h] = np.concatenate([self.levels[h], v])
+
+    def compress(self):
+        h = 0
+        while h < len(self.levels):
+            lev = self.levels[h]
+            if len(lev) > self.k:
+                lev = np.sort(lev)
+                keep = lev[-1:] if len(lev) % 2 == 1 else lev[:0]
+                lev = lev[:len(lev) - len(keep)]
+                self._add(h+1, lev[self.rng.integers(2)::2])
+                self.levels[h] = keep
+            h += 1
+
+    def merge(self, other):
+        assert self.k == other.k, "QuantileSketch: mismatched k"
+        for h, lev in enumerate(other.levels):
+            self._add(h, lev)
+        self.n += other.n
+        self.compress()
+        return self
+
+    def quantile(self, q):
+        """Estimated q-quantile(s), for 0 <= q <= 1.
+
+        Args:
+            q: float or list of floats
+
+        Returns:
+            float (or np.ndarray for a list of q)
+        """
+        if self.n == 0:
+            return np.nan if np.ndim(q) == 0 else np.full(len(q), np.nan)
+        vals = np.concatenate(self.levels)
+        wts = np.concatenate([np.full(len(lev), 2**h)
+                              for h, lev in enumerate(self.levels)])
+        perm = np.argsort(vals, kind="stable")
+        vals = vals[perm]
+        cum = np.cumsum(wts[perm])
+        i = np.searchsorted(cum, np.asarray(q) * cum[-1], side="left")
+        ans = vals[np.minimum(i, len(vals)-1)]
+        return float(ans) if np.ndim(q) == 0 else ans
+
+class CountMin:
+    """Approximate counts of each value (count-min sketch).
+
+    Estimates never undercount, and overcount by at most
+    about 2n/width with probability 1 - 2**-depth.
+
+    Args:
+        width: counters per row
+        depth: number of rows (independent hashes)
+    """
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.int64)
+
+    def _cols(self, values):
+        return [ (hash64(values, seed=i+1) % np.uint64(self.width)).astype(np.int64)
+                 for i in range(self.depth) ]
+
+    def update(self, values):
+        for row, idx in zip(self.table, self._cols(values)):
+            row += np.bincount(idx, minlength=self.width)
+        return self
+
+    def merge(self, other):
+        assert self.table.shape == other.table.shape, \
+                "CountMin: mismatched shape"
+        self.table += other.table
+        return self
+
+    def estimate(self, values):
+        """Estimated counts of each of values.
+
+        Returns:
+            np.ndarray of np.int64
+        """
+        cols = self._cols(values)
+        return np.min([row[idx] for row, idx in zip(self.table, cols)], axis=0)
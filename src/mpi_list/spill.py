@@ -0,0 +1,182 @@
+# Out-of-core grouping.
+#
+# Like gather_partitions, but received blocks are held in a
+# buffer of at most `max_bytes` (pickled size).  When the buffer
+# fills, it is sorted by output index and written to a run file.
+# The output is a SpillList, which merges the runs (heapq.merge)
+# each time it is iterated, building one output element at a time.
+#
+# Blocks move in P-1 ring steps (send to rank+k, receive from
+# rank-k), one chunk of about max_bytes/4 at a time, so only
+# the outgoing sets (built by the caller) are fully in memory.
+import os
+import heapq
+import pickle
+import shutil
+import tempfile
+import weakref
+from itertools import groupby, islice
+
+from .gather import dest_sets
+from .trace import count
+
+SPILL_TAG = 53
+
+def _chunks(recs, nbytes):
+    # Pickle the values of (seq, p) records, in lists of about nbytes.
+    out = []
+    size = 0
+    for seq, p in recs:
+        blob = pickle.dumps(p, protocol=pickle.HIGHEST_PROTOCOL)
+        out.append( (seq, blob) )
+        size += len(blob)
+        if size >= nbytes:
+            yield out
+            out = []
+            size = 0
+    if len(out) > 0:
+        yield out
+
+def _read_run(fname):
+    with open(fname, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+class SpillList:
+    """Read-only list of grouped elements, merged lazily
+    from sorted run files (see `DFM.group`).
+
+    Iterating streams through all runs, so only one
+    output element is built at a time.  Indexing
+    iterates from the start, so prefer iteration.
+    Pickling it (e.g. to send it) builds a regular list.
+
+    Attributes:
+        path: directory holding the run files
+              (removed when the SpillList is freed)
+    """
+    def __init__(self, path, runs, tail, concat, n):
+        self.path = path
+        self.runs = runs # run file names
+        self.tail = tail # last (sorted) run, still in memory
+        self.concat = concat
+        self.n = n
+        self._cleanup = weakref.finalize(self, shutil.rmtree, path, True)
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        recs = heapq.merge(*[_read_run(r) for r in self.runs], self.tail,
+                           key=lambda x: x[0])
+        for seq, grp in groupby(recs, key=lambda x: x[0]):
+            items = []
+            for _, blob in grp:
+                items.extend( pickle.loads(blob) )
+            yield self.concat(items)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(islice(iter(self), *i.indices(self.n)))
+        if i < 0:
+            i += self.n
+        if not 0 <= i < self.n:
+            raise IndexError("SpillList index out of range")
+        return next(islice(iter(self), i, None))
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+    def __repr__(self):
+        return f"SpillList(n={self.n}, runs={len(self.runs)})"
+
+class _RunWriter:
+    # Buffer (seq, blob) records, spilling sorted runs to disk.
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.buf = []
+        self.size = 0
+        self.runs = []
+        self.seqs = set()
+
+    def add(self, recs):
+        for seq, blob in recs:
+            self.buf.append( (seq, blob) )
+            self.size += len(blob)
+            self.seqs.add(seq)
+        if self.size > self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        if len(self.buf) == 0:
+            return
+        fname = os.path.join(self.path, f"run-{len(self.runs):05d}")
+        with open(fname, "wb") as f:
+            for rec in self.sorted():
+                pickle.dump(rec, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.runs.append(fname)
+        self.buf = []
+        self.size = 0
+
+    def sorted(self):
+        self.buf.sort(key=lambda x: x[0]) # stable
+        return self.buf
+
+def gather_spill(C, dP, N, concat, max_bytes, spill_dir=None):
+    """Out-of-core version of `gather_partitions`
+    followed by `concat` on every group.
+
+    Note:
+        This must be called by all ranks.
+
+    Args:
+        C: Context
+        dP: {seq : [e']} from current rank
+        N: Number of output elements
+        concat: function of type = [e'] -> new elem
+        max_bytes: memory for received (pickled) blocks
+        spill_dir: parent directory for run files
+                   (default: the system temp directory)
+
+    Returns:
+        SpillList of new elems for the sequence numbers
+        belonging to the current rank (ascending).
+        Within each group, blocks from this rank come first,
+        then from ranks rank-1, rank-2, ... (mod procs).
+    """
+    sets = dest_sets(C, dP, N)
+    path = tempfile.mkdtemp(prefix=f"mpi_list-{C.rank}-", dir=spill_dir)
+    out = _RunWriter(path, max_bytes)
+    chunk = max(1, max_bytes // 4)
+    for recs in _chunks(sets[C.rank], chunk):
+        out.add(recs)
+
+    with C.span("gather_spill") as info:
+        for k in range(1, C.procs):
+            dst = (C.rank + k) % C.procs
+            src = (C.rank - k) % C.procs
+            gen = _chunks(sets[dst], chunk)
+            sending = receiving = True
+            # Every message to dst is a chunk, then None.
+            while sending or receiving:
+                req = None
+                if sending:
+                    x = next(gen, None)
+                    sending = x is not None
+                    count(C, info, "bytes_sent", x)
+                    req = C.comm.isend(x, dest=dst, tag=SPILL_TAG)
+                if receiving:
+                    x = C.comm.recv(source=src, tag=SPILL_TAG)
+                    receiving = x is not None
+                    if receiving:
+                        count(C, info, "bytes_recv", x)
+                        out.add(x)
+                if req is not None:
+                    req.wait()
+    del sets
+
+    return SpillList(path, out.runs, out.sorted(), concat, len(out.seqs))
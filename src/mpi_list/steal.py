@@ -0,0 +1,130 @@
+# Dynamic (work-stealing) map.
+#
+# Every rank works through its queue -- initially its own
+# elements -- from the front.  An idle rank asks another rank
+# for work, and the victim replies (between elements) with half
+# of its remaining queue, taken from the back.  Stolen work
+# joins the thief's queue, so it can be stolen again.
+# Completed work is counted with an MPI atomic on rank 0,
+# so every rank can tell when all elements are done.  A final non-blocking barrier keeps
+# ranks answering (empty) steal requests until everyone is finished.
+
+from collections import deque
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .gather import sparse_exchange
+
+REQ_TAG = 50
+REP_TAG = 51
+
+class Counter:
+    # Global counter, stored on rank 0 and updated atomically.
+    def __init__(self, C):
+        self.MPI = C.MPI
+        size = 8 if C.rank == 0 else 0
+        self.win = C.MPI.Win.Allocate(size, 8, comm=C.comm)
+        if C.rank == 0:
+            self.win.Lock(0)
+            self.win.Put([np.zeros(1, dtype=np.int64), C.MPI.INT64_T], 0)
+            self.win.Unlock(0)
+        C.comm.Barrier()
+
+    def add(self, n):
+        # Add n and return the new value.
+        x = np.array([n], dtype=np.int64)
+        old = np.zeros(1, dtype=np.int64)
+        self.win.Lock(0, self.MPI.LOCK_SHARED)
+        self.win.Fetch_and_op([x, self.MPI.INT64_T],
+                              [old, self.MPI.INT64_T],
+                              0, 0, self.MPI.SUM)
+        self.win.Unlock(0)
+        return int(old[0]) + n
+
+    def free(self):
+        self.win.Free()
+
+def map_dynamic(C, E, f):
+    """Apply f to all elements of E, balancing work between ranks.
+
+    Note:
+        This must be called by all ranks.
+
+    Args:
+        C: Context
+        E: local elements
+        f: function of type = elem -> new elem
+
+    Returns:
+        [f(e) for e in E] -- though some may have been
+        computed on other ranks.
+    """
+    total = C.comm.allreduce(len(E))
+    res = [None]*len(E)
+    if C.procs == 1:
+        for i, e in enumerate(E):
+            res[i] = f(e)
+        return res
+
+    comm = C.comm
+    status = C.MPI.Status()
+    count = Counter(C)
+    q = deque( (C.rank, i, e) for i, e in enumerate(E) ) # (owner, i, e)
+    replies = []    # outstanding reply sends
+    stolen = [[] for r in range(C.procs)] # (i, f(e)) owned by rank r
+
+    def serve():
+        # Answer all pending steal requests.
+        while comm.iprobe(source=C.MPI.ANY_SOURCE, tag=REQ_TAG,
+                          status=status):
+            src = status.Get_source()
+            comm.recv(source=src, tag=REQ_TAG)
+            chunk = [ q.pop() for k in range(len(q) // 2) ]
+            chunk.reverse()
+            replies.append( comm.isend(chunk, dest=src, tag=REP_TAG) )
+
+    def steal(victim):
+        req = comm.isend(None, dest=victim, tag=REQ_TAG)
+        while not comm.iprobe(source=victim, tag=REP_TAG):
+            serve()
+        chunk = comm.recv(source=victim, tag=REP_TAG)
+        req.wait()
+        return chunk
+
+    pending = 0 # completed, but not yet added to count
+    k = 0       # steal attempts
+    while True:
+        serve()
+        if len(q) > 0:
+            owner, i, e = q.popleft()
+            if owner == C.rank:
+                res[i] = f(e)
+            else:
+                stolen[owner].append( (i, f(e)) )
+            pending += 1
+            continue
+        if count.add(pending) == total:
+            break
+        pending = 0
+
+        victim = (C.rank + 1 + k % (C.procs-1)) % C.procs
+        k += 1
+        q.extend( steal(victim) )
+
+    # Keep answering requests until all ranks are done.
+    done = comm.Ibarrier()
+    while not done.Test():
+        serve()
+    for r in replies:
+        r.wait()
+    count.free()
+
+    # return stolen results to their owners
+    back = { r: x for r, x in enumerate(stolen) if len(x) > 0 }
+    for src, x in sparse_exchange(C, back):
+        for i, y in x:
+            res[i] = y
+    return res
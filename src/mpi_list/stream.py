@@ -0,0 +1,154 @@
+# Micro-batch streaming.
+#
+# A Stream pulls one batch (a list of elements) at a time
+# from a per-rank source iterator, wraps it in a DFM,
+# and runs a stored pipeline of DFM operations on it.
+# The next batch is read on a background thread while
+# the current one is processed.  The stream ends once
+# every rank's source is exhausted.
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .gather import gather_partitions
+from .sketch import hash64
+
+class Stream:
+    """Unbounded sequence of DFM batches.
+
+    Create with `Context.stream`.  Transformations (map,
+    filter, flatMap, group, transform) are stored and applied
+    to each batch.  Iterating over a Stream yields the
+    transformed DFM for each batch::
+
+        S = C.stream(source).map(parse).filter(valid)
+        for dfm in S:
+            print(dfm.len())
+
+    Note:
+        Iteration is collective, and all Streams derived
+        from one source share it, so only iterate over one of them.
+
+    Attributes:
+        C: Context
+        source: iterator of [elem] (this rank's batches)
+        ops: [DFM -> DFM] applied to each batch
+        prefetch: read the next batch on a background thread?
+    """
+    def __init__(self, C, source, ops=(), prefetch=True):
+        self.C = C
+        self.source = source
+        self.ops = list(ops)
+        self.prefetch = prefetch
+
+    def transform(self, g):
+        """Add a step to the pipeline.
+
+        Args:
+            g: function of type = DFM -> DFM
+
+        Returns:
+            new Stream
+        """
+        return Stream(self.C, self.source, self.ops + [g], self.prefetch)
+
+    def map(self, f):
+        """See `DFM.map`."""
+        return self.transform(lambda d: d.map(f))
+
+    def filter(self, f):
+        """See `DFM.filter`."""
+        return self.transform(lambda d: d.filter(f))
+
+    def flatMap(self, f):
+        """See `DFM.flatMap`."""
+        return self.transform(lambda d: d.flatMap(f))
+
+    def group(self, f, concat, N):
+        """See `DFM.group` (applied to each batch separately)."""
+        return self.transform(lambda d: d.group(f, concat, N))
+
+    def batches(self):
+        """Iterate over the untransformed batches.
+
+        Yields:
+            DFM (empty on ranks whose source has run out)
+        """
+        from .dfm import DFM
+        src = iter(self.source)
+        done = False
+        def pull():
+            return next(src, None)
+
+        pool = ThreadPoolExecutor(1) if self.prefetch else None
+        nxt = pool.submit(pull) if pool is not None else None
+        try:
+            while True:
+                E = None
+                if not done:
+                    E = nxt.result() if pool is not None else pull()
+                    done = E is None
+                    if pool is not None and not done:
+                        nxt = pool.submit(pull) # overlaps the work below
+                if not self.C.comm.allreduce(not done, op=self.C.MPI.LOR):
+                    return
+                yield DFM(self.C, [] if E is None else list(E))
+        finally:
+            if pool is not None: # (cancel_futures needs Python 3.9)
+                nxt.cancel()
+                pool.shutdown(wait=False)
+
+    def __iter__(self):
+        for d in self.batches():
+            for g in self.ops:
+                d = g(d)
+            yield d
+
+    def reduceByKey(self, f, window=None):
+        """Running per-key reduction over the stream.
+
+        Stream elements must be (key, value) pairs.
+        Each batch is reduced locally, then the pairs are
+        shuffled so that every key is owned by one rank
+        (using `gather_partitions` and a process-independent hash),
+        and merged into that rank's state.
+
+        Args:
+            f: associative function of type = value, value -> value
+            window: if given, only the last `window` batches
+                    are included in the result (otherwise,
+                    all batches so far)
+
+        Yields:
+            DFM of (key, reduced value) pairs for each batch,
+            holding every key seen in the window
+        """
+        from .dfm import DFM
+        C = self.C
+        recent = deque()
+        total = {}
+        for d in self:
+            part = {}
+            for k, v in d.E:
+                part[k] = f(part[k], v) if k in part else v
+            dP = {}
+            keys = list(part.keys())
+            if len(keys) > 0:
+                for k, r in zip(keys, hash64(keys) % C.procs):
+                    dP.setdefault(int(r), []).append( (k, part[k]) )
+            part = {}
+            for grp in gather_partitions(C, dP, C.procs):
+                for k, v in grp:
+                    part[k] = f(part[k], v) if k in part else v
+
+            if window is None:
+                for k, v in part.items():
+                    total[k] = f(total[k], v) if k in total else v
+            else:
+                recent.append(part)
+                if len(recent) > window:
+                    recent.popleft()
+                total = {}
+                for p in recent:
+                    for k, v in p.items():
+                        total[k] = f(total[k], v) if k in total else v
+            yield DFM(C, list(total.items()))
@@ -0,0 +1,128 @@
+# Opt-in tracing of DFM operations.
+#
+# Events are recorded per-rank in Chrome's trace-event format
+# (complete events, "ph": "X"), so the merged output of
+# Context.write_trace can be loaded into chrome://tracing
+# or https://ui.perfetto.dev.
+import time
+import json
+import pickle
+import functools
+from contextlib import contextmanager
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+@contextmanager
+def null_span():
+    yield {}
+
+def nbytes(obj):
+    """Approximate number of bytes needed to send obj.
+
+    Note:
+        This pickles non-array objects, so it is only
+        called when tracing is enabled.
+    """
+    if np is not None and isinstance(obj, np.ndarray):
+        return obj.nbytes
+    return len(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+def count(C, info, key, obj):
+    """Add nbytes(obj) to info[key] if C is tracing."""
+    if C.tracer is not None:
+        info[key] = info.get(key, 0) + nbytes(obj)
+
+class Tracer:
+    """Per-rank event recorder.
+
+    Attributes:
+        rank: rank recorded as the event's pid
+        events: list of trace events
+        t0: local time origin (seconds)
+    """
+    def __init__(self, rank):
+        self.rank = rank
+        self.events = []
+        self.t0 = time.perf_counter()
+
+    @contextmanager
+    def span(self, name, cat="compute", **args):
+        """Record the duration of a block.
+
+        Yields the event's `args` dictionary, so callers
+        can add counts computed inside the block.
+        """
+        t = time.perf_counter()
+        ev = { "name": name, "cat": cat, "ph": "X",
+               "pid": self.rank, "tid": 0,
+               "ts": (t - self.t0)*1e6, "args": args }
+        try:
+            yield args
+        finally:
+            ev["dur"] = (time.perf_counter() - t)*1e6
+            self.events.append(ev)
+
+    def summary(self):
+        """Totals per operation name on this rank.
+
+        Returns:
+            {name: {"count", "time", "comm", "bytes_sent", "bytes_recv"}}
+            where "time" is wall time (s) and "comm" is the
+            time (s) spent inside nested "comm" events.
+        """
+        ans = {}
+        evs = sorted(self.events, key=lambda e: (e["ts"], -e["dur"]))
+        stack = [] # enclosing non-comm events
+        for e in evs:
+            end = e["ts"] + e["dur"]
+            while len(stack) > 0 and stack[-1][1] < end:
+                stack.pop()
+            if e["cat"] == "comm":
+                for s, _ in stack:
+                    s["comm"] += e["dur"]*1e-6
+            s = ans.setdefault(e["name"], { "count": 0, "time": 0.0,
+                        "comm": 0.0, "bytes_sent": 0, "bytes_recv": 0 })
+            s["count"] += 1
+            s["time"] += e["dur"]*1e-6
+            s["bytes_sent"] += e["args"].get("bytes_sent", 0)
+            s["bytes_recv"] += e["args"].get("bytes_recv", 0)
+            if e["cat"] != "comm":
+                stack.append((s, end))
+        return ans
+
+def traced(method):
+    """Record a span for every call to a DFM method
+    (when its Context has a tracer).
+
+    The span records the number of local elements
+    going in, and coming out (if a DFM is returned).
+    """
+    name = method.__name__
+    @functools.wraps(method)
+    def wrap(self, *args, **kws):
+        T = self.C.tracer
+        if T is None:
+            return method(self, *args, **kws)
+        with T.span(name, "dfm", n_in=len(self.E)) as info:
+            ans = method(self, *args, **kws)
+            if hasattr(ans, "E") and hasattr(ans, "C"):
+                info["n_out"] = len(ans.E)
+        return ans
+    return wrap
+
+def write_trace(C, fname, root=0):
+    # Gather all events to root and write them out as JSON.
+    events = C.comm.gather(C.tracer.events, root=root)
+    if C.rank != root:
+        return
+    out = []
+    for ev in events:
+        out.extend(ev)
+    for r in sorted(set(ev["pid"] for ev in out)):
+        out.append({ "name": "process_name", "ph": "M", "pid": r,
+                     "args": {"name": f"rank {r}"} })
+    with open(fname, "w") as f:
+        json.dump({"traceEvents": out, "displayTimeUnit": "ms"}, f)
@@ -0,0 +1,183 @@
+# Communication parameters, calibrated per machine and MPI library.
+#
+# `params` holds the values used by chunked transfers
+# (CommReducer's raw-buffer path, Broadcast, send_chunks).
+# The defaults are safe everywhere.  Context.autotune replaces
+# them with values measured by a ping-pong between two ranks
+# (on different nodes, if there are several), and caches the
+# result on disk, so later jobs only read the file.
+import os
+import re
+import json
+import time
+import hashlib
+import platform
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class Params:
+    """Communication parameters.
+
+    Attributes:
+        chunk: bytes per message for large raw-buffer transfers
+               (at most 1<<30, since MPI counts are ints)
+        max_elems: elements per message when sending long lists
+                   of objects in chunks
+        pickle_max: arrays smaller than this many bytes are
+                    pickled instead of sent as raw buffers
+        eager: largest message size sent before a rendezvous
+               protocol takes over (None if no switch was seen)
+        latency: small-message latency (s), if measured
+        bandwidth: large-message bandwidth (bytes/s), if measured
+    """
+    def __init__(self, chunk=1<<30, max_elems=100000, pickle_max=0,
+                 eager=None, latency=None, bandwidth=None):
+        self.chunk = chunk
+        self.max_elems = max_elems
+        self.pickle_max = pickle_max
+        self.eager = eager
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    def asdict(self):
+        return dict(vars(self))
+
+    def __repr__(self):
+        return f"Params({self.asdict()})"
+
+params = Params() # current values (the same on all ranks)
+
+SIZES = [1 << k for k in range(3, 25, 3)] # 8 B ... 16 MiB
+TUNE_TAG = 56
+
+def cache_file(C, remote):
+    """Default cache location for this machine and MPI library.
+
+    Digits are dropped from the host name, so all nodes
+    of a cluster share one entry.
+    """
+    key = "|".join([ re.sub(r"\d+", "", platform.node()),
+                     C.MPI.Get_library_version().strip("\x00 \n"),
+                     "net" if remote else "shm" ])
+    h = hashlib.sha1(key.encode()).hexdigest()[:16]
+    base = os.environ.get("XDG_CACHE_HOME",
+                          os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "mpi_list", f"tune-{h}.json")
+
+def partner(C):
+    # Rank to ping-pong with rank 0 -- the leader of
+    # another node if there is one, else rank 1.
+    node, leaders = C.topology()
+    p = None
+    if leaders is not None and leaders.procs > 1:
+        p = leaders.comm.bcast(C.rank if leaders.rank == 1 else None, root=1)
+    p = C.comm.bcast(p, root=0)
+    return (1, False) if p is None else (p, True)
+
+def pingpong(C, peer, send, recv, reps):
+    # Mean one-way time of `reps` round trips between rank 0 and peer.
+    C.comm.Barrier()
+    if C.rank not in (0, peer):
+        return None
+    t0 = time.perf_counter()
+    for i in range(reps):
+        if C.rank == 0:
+            send(peer)
+            recv(peer)
+        else:
+            recv(0)
+            send(0)
+    return (time.perf_counter() - t0) / (2*reps)
+
+def measure(C, peer):
+    # {size: (raw time, pickled time)} on ranks 0 and peer
+    ans = {}
+    for n in SIZES:
+        buf = np.zeros(n, dtype=np.uint8)
+        reps = max(3, min(200, (1 << 24) // n))
+        raw = pingpong(C, peer,
+                lambda r: C.comm.Send(buf, dest=r, tag=TUNE_TAG),
+                lambda r: C.comm.Recv(buf, source=r, tag=TUNE_TAG), reps)
+        pkl = pingpong(C, peer,
+                lambda r: C.comm.send(buf, dest=r, tag=TUNE_TAG),
+                lambda r: C.comm.recv(source=r, tag=TUNE_TAG), reps)
+        ans[n] = (raw, pkl)
+    return ans
+
+def derive(times):
+    """Pick parameters from ping-pong times.
+
+    Args:
+        times: {size: (raw time, pickled time)}
+
+    Returns:
+        Params
+    """
+    sizes = sorted(times)
+    raw = [times[n][0] for n in sizes]
+    latency = raw[0]
+    bw = [n/t for n, t in zip(sizes, raw)]
+    bandwidth = max(bw)
+
+    # Messages of 64x the smallest size reaching 90% of peak
+    # bandwidth spend < ~0.2% of their time on per-message costs.
+    s90 = next(n for n, b in zip(sizes, bw) if b >= 0.9*bandwidth)
+    chunk = min(max(64*s90, 1 << 22), 1 << 30)
+
+    # A rendezvous adds a round trip: look for a step in time
+    # beyond what the extra bytes explain.
+    eager = None
+    for i in range(len(sizes)-1):
+        extra = raw[i+1] - raw[i] - (sizes[i+1]-sizes[i]) / bandwidth
+        if extra > 2*latency:
+            eager = sizes[i]
+            break
+
+    # pickling is fine up to the largest size where it is no slower
+    pickle_max = 0
+    for n in sizes:
+        if times[n][1] <= times[n][0]:
+            pickle_max = 2*n
+        else:
+            break
+
+    return Params(chunk=chunk, max_elems=max(1000, chunk // 1024),
+                  pickle_max=pickle_max, eager=eager,
+                  latency=latency, bandwidth=bandwidth)
+
+def autotune(C, path=None, force=False):
+    """Calibrate (or load cached) communication parameters,
+    and use them from now on (see `Context.autotune`).
+    """
+    global params
+    if C.procs < 2 or np is None:
+        return params # nothing to measure
+
+    peer, remote = partner(C)
+    if path is None:
+        path = cache_file(C, remote)
+
+    ans = None
+    if C.rank == 0 and not force:
+        try:
+            with open(path) as f:
+                ans = json.load(f)
+        except (OSError, ValueError):
+            pass
+    ans = C.comm.bcast(ans, root=0)
+    if ans is None:
+        times = measure(C, peer)
+        if C.rank == 0:
+            ans = derive(times).asdict()
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "w") as f:
+                    json.dump(ans, f, indent=1)
+            except OSError:
+                pass
+        ans = C.comm.bcast(ans, root=0)
+    params = Params(**ans)
+    return params
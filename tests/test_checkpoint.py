@@ -0,0 +1,56 @@
+import pytest
+import os
+
+from mpi_list import Context
+
+__author__ = "David M. Rogers"
+__copyright__ = "Oak Ridge National Lab"
+__license__ = "MIT"
+
+import numpy as np
+
+def test_checkpoint(tmp_path, N=37):
+    C = Context()
+    path = C.comm.bcast(str(tmp_path / "ckpt"))
+
+    dfm = C.iterates(N)
+    arr = dfm.map(lambda i: np.full(i % 5, i))
+    obj = dfm.map(lambda i: {"i": i, "s": str(i)}) \
+             .filter(lambda x: x["i"] % 3 != 0) # uneven layout
+
+    assert arr.checkpoint(path + "/arr") is arr
+    obj.checkpoint(path + "/obj")
+    assert os.path.exists(path + "/arr/manifest.json")
+
+    # same number of ranks: same layout
+    A = C.restore(path + "/arr")
+    assert len(A.E) == len(arr.E)
+    for a, b in zip(A.E, arr.E):
+        assert a.dtype == b.dtype and (a == b).all()
+    B = C.restore(path + "/obj")
+    assert B.E == obj.E
+
+    # fewer ranks: spread evenly, in order
+    full = obj.collect(None)
+    C2 = C.split(0 if C.rank < (C.procs+1)//2 else 1)
+    B2 = C2.restore(path + "/obj")
+    assert abs(len(B2.E) - obj.len()/C2.procs) < 1
+    ans = B2.collect()
+    if C2.rank == 0:
+        assert ans == full
+    A2 = C2.restore(path + "/arr")
+    assert [int(a.sum()) for a in A2.collect(None)] == \
+           [(i % 5) * i for i in range(N)]
+
+    with pytest.raises(FileNotFoundError):
+        C.restore(path + "/missing")
+
+def test_checkpoint_error(tmp_path):
+    C = Context()
+    path = C.comm.bcast(str(tmp_path / "bad"))
+    # an unpicklable element on one rank fails every rank
+    dfm = C.iterates(C.procs).map(
+            lambda i: (lambda: i) if i == C.procs-1 else i)
+    with pytest.raises(RuntimeError, match=f"rank {C.procs-1}"):
+        dfm.checkpoint(path)
+    assert not os.path.exists(path + "/manifest.json")
@@ -44,6 +44,84 @@ def test_head(N=107, M=3):
     assert h[0] == 0
     assert h[-1] == len(h)-1
 
+def test_head_sparse(N=50):
+    C = Context()
+
+    # only the last rank has elements
+    dfm = C . iterates(N) . filter(lambda x: x >= N - N//C.procs)
+    h = dfm.head(3)
+    assert h == list(range(N - N//C.procs, N))[:3]
+    assert dfm.head(0) == []
+    assert len(dfm.head(N)) == N//C.procs
+
+def test_take(N=50):
+    C = Context()
+
+    dfm = C . iterates(N)
+    assert dfm.take(5, 9) == list(range(5, 9))[:max(0,N-5)]
+    assert dfm.take(N-2, N+10) == list(range(max(0,N-2), N))
+    assert dfm.take(3, 3) == []
+
+@pytest.mark.parametrize("chunk", [None, 1, 4])
+def test_collect_iter(tmp_path, chunk, N=23):
+    import pickle
+    C = Context()
+    dfm = C.iterates(N).filter(lambda i: i % 3 != 1)
+    ref = dfm.collect()
+    for root in [0, C.procs-1]:
+        ans = list(dfm.collect_iter(root=root, chunk=chunk))
+        if C.rank == root:
+            assert ans == [i for i in range(N) if i % 3 != 1]
+        else:
+            assert ans == []
+
+    # stop early
+    seen = []
+    for e in dfm.collect_iter(chunk=chunk):
+        seen.append(e)
+        if len(seen) == 5:
+            break
+    if C.rank == 0:
+        assert seen == ref[:5]
+    assert dfm.len() == len([i for i in range(N) if i % 3 != 1])
+
+    fname = C.comm.bcast(str(tmp_path / "out.pkl"))
+    n = dfm.collect_to(fname, chunk=chunk)
+    if C.rank == 0:
+        assert n == len(ref)
+        with open(fname, "rb") as f:
+            assert [pickle.load(f) for i in range(n)] == ref
+    else:
+        assert n is None
+
+def test_sample(N=200):
+    C = Context()
+
+    dfm = C . iterates(N)
+    s = dfm.takeSample(10, seed=4)
+    assert len(s) == min(10, N)
+    assert len(set(s)) == len(s)
+    assert all(0 <= x < N for x in s)
+    assert sorted(dfm.takeSample(N+5, seed=1)) == list(range(N))
+
+    # ranks agree on the result, even without a seed
+    assert C.comm.allgather(s) == [s]*C.procs
+    s = dfm.takeSample(N)
+    assert C.comm.allgather(s) == [s]*C.procs
+
+    n = dfm.sample(0.5, seed=2).len()
+    assert 0 < n < N or N < 20
+    assert dfm.sample(1.0).len() == N
+    assert dfm.sample(0.0).len() == 0
+
+def test_topk(N=97):
+    C = Context()
+
+    dfm = C . iterates(N) . map(lambda x: (x*37) % N)
+    assert dfm.takeOrdered(5) == list(range(min(5,N)))
+    assert dfm.topk(3) == list(range(N-1, N-4, -1))[:N]
+    assert dfm.takeOrdered(2, key=lambda x: -x) == list(range(N-1, N-3, -1))[:N]
+
 def test_reduce(N=101):
     C = Context()
 
@@ -67,6 +145,68 @@ def test_reduce(N=101):
     if N >= 1:
         assert ans[0] == 0 and ans[-1] == N-1
 
+    # separate element and merge functions
+    add = lambda a,b: a+b
+    ans = dfm.reduce(add, 0, seq=lambda a,e: a+e[0])
+    assert ans == N*(N-1) // 2
+    ans = dfm.reduce(add, 0, fold=lambda a,E: a+len(E))
+    assert ans == N
+
+def test_aggregate(N=101):
+    import numpy as np
+    C = Context()
+
+    add = lambda a,b: a+b
+    def hist(a, e):
+        a[e%5] += 1
+        return a
+    n, s, m, h = C.iterates(N).aggregate(
+                    (0, lambda a,e: a+1, add),
+                    (0, add, add),
+                    (-1, max, max),
+                    (np.zeros(5, dtype=int), hist, add) )
+    assert n == N
+    assert s == N*(N-1)//2
+    assert m == N-1
+    assert h.sum() == N and h[0] == (N+4)//5
+
+    assert C.iterates(N).aggregate() == []
+
+def test_map_dynamic(N=60):
+    import time
+    C = Context()
+
+    def slow(x):
+        if x < N//4: # first rank(s) have all the work
+            time.sleep(0.005)
+        return x*x
+
+    dfm = C . iterates(N)
+    ans = dfm . map_dynamic(slow)
+    assert len(ans.E) == len(dfm.E)
+    assert ans.E == [x*x for x in dfm.E]
+
+    ans = C . iterates(N) . filter(lambda x: x < 3) . map_dynamic(slow)
+    assert ans.len() == min(N, 3)
+
+def test_map_dynamic_balance(N=160, M=40):
+    import time
+    C = Context()
+
+    def slow(x): # all slow elements start on rank 0
+        if x < M:
+            time.sleep(0.01)
+            return C.rank
+        return None
+
+    ans = C.iterates(N).map_dynamic(slow).collect()
+    if C.rank == 0 and C.procs >= 3:
+        work = [ans.count(r) for r in range(C.procs)]
+        assert sum(work) == M
+        # stolen chunks are themselves re-stolen, so no rank
+        # is stuck with the first half-queue steal
+        assert max(work) < M//2
+
 def test_filter(N=223):
     C = Context()
 
@@ -76,6 +216,24 @@ def test_filter(N=223):
       ans = dfm . filter(lambda x: x % n == n-1)
       assert ans.len() == N // n
 
+def test_rebalance(N=200):
+    C = Context()
+
+    dfm = C . iterates(N) . filter(lambda x: x < N//3)
+    bal = dfm.rebalance()
+    assert len(bal.E) == len(C.iterates(N//3).E)
+    ans = bal.collect()
+    if C.rank == 0:
+        assert ans == list(range(N//3))
+
+    assert bal.rebalance() is bal
+    assert dfm.rebalance(threshold=1e9) is dfm
+
+    C.auto_balance = 1.5
+    dfm = C . iterates(N) . flatMap(lambda x: [x]*(x%2) if x > N//2 else [])
+    assert len(dfm.E) == len(C.iterates(dfm.len()).E)
+    C.auto_balance = None
+
 def test_flatmap():
     C = Context()
 
@@ -90,6 +248,47 @@ def test_flatmap():
         assert ans[-2] == '9'
         assert ans[-1] == '9'
 
+@pytest.mark.parametrize("k", [1, 2, 3, 7])
+def test_window(k, N=20):
+    C = Context()
+    ref = [sum(range(i, i+k)) for i in range(N-k+1)]
+    dfm = C.iterates(N)
+    assert dfm.window(k, sum).collect(None) == ref
+
+    # uneven layout, with empty ranks
+    odd = dfm.filter(lambda i: C.rank % 2 == 1 or i < 2)
+    E = odd.collect(None)
+    ans = odd.window(k, list)
+    assert ans.collect(None) == [E[i:i+k] for i in range(len(E)-k+1)]
+    assert ans.len() == max(0, len(E)-k+1)
+
+    # too short
+    assert C.iterates(k-1).window(k, sum).len() == 0
+
+def test_cartesian(N=11, M=6):
+    C = Context()
+    a = C.iterates(N).filter(lambda i: i % 4 != 1) # uneven layout
+    b = C.iterates(M, robin=True).map(lambda j: -j)
+    A, B = a.collect(None), b.collect(None)
+    ans = a.cartesian(b, lambda x, y: (x, y))
+    assert ans.collect(None) == [(x, y) for x in A for y in B]
+    # rows stay with their element
+    assert len(ans.E) == len(a.E)*M
+
+    sq = b.allpairs(lambda x, y: x*y).collect(None)
+    assert sq == [x*y for x in B for y in B]
+    empty = C.iterates(N).filter(lambda i: False)
+    assert a.cartesian(empty, lambda x, y: 0).len() == 0
+
+    # large blocks (sent with a rendezvous)
+    import numpy as np
+    big = C.iterates(C.procs).map(lambda i: np.full(1 << 17, float(i)))
+    tot = big.cartesian(big, lambda x, y: float(x[0] * y[0])).collect(None)
+    assert tot == [float(i*j) for i in range(C.procs) for j in range(C.procs)]
+
+    with pytest.raises(AssertionError):
+        a.cartesian(Context().iterates(M), lambda x, y: 0)
+
 def test_nodemap(N=100):
     C = Context()
 
@@ -106,6 +305,102 @@ def test_nodemap(N=100):
     if N > 0:
         assert v[0][0] == 0 and v[0][1] == (N // C.procs) + (N % C.procs != 0)
 
+def test_split(N=31):
+    C = Context()
+
+    C2 = C.split(C.rank % 2)
+    assert C2.procs == (C.procs + 1 - C.rank%2) // 2
+    assert C2.rank == C.rank // 2
+
+    dfm = C2 . iterates(N)
+    assert dfm.len() == N
+    ans = dfm . reduce(lambda a,b: a+b, 0)
+    assert ans == N*(N-1) // 2
+
+    assert C.split(None) is None
+
+    Cn = C.split_shared()
+    assert Cn.iterates(N).len() == N
+
+def test_broadcast(N=50):
+    import numpy as np
+    C = Context()
+
+    root = C.procs-1
+    x = None
+    if C.rank == root:
+        x = np.arange(3*N).reshape(N,3)
+    tbl = C.broadcast(x, root=root)
+    assert tbl.value.shape == (N,3)
+    assert not tbl.value.flags.writeable
+
+    ans = C.iterates(N).map(lambda i: tbl.value[i,2]).collect()
+    if C.rank == 0:
+        assert ans == list(range(2, 3*N, 3))
+    tbl.free()
+
+    obj = C.broadcast({'a': C.rank}, root=root)
+    assert obj.value == {'a': root}
+    obj.free()
+
+    # object arrays are pickled, not shared
+    x = np.array([{'a': 1}, None], dtype=object) if C.rank == root else None
+    obj = C.broadcast(x, root=root)
+    assert obj.win is None
+    assert obj.value[0] == {'a': 1} and obj.value[1] is None
+    obj.free()
+
+    # 0-d and empty arrays
+    for x in [np.float64(2.5)*np.ones(()), np.zeros((0,3))]:
+        obj = C.broadcast(x if C.rank == root else None, root=root)
+        assert obj.value.shape == x.shape and np.all(obj.value == x)
+        obj.free()
+
+def test_accumulator(N=40):
+    import numpy as np
+    C = Context()
+
+    dropped = C.accumulator(0)
+    total = C.accumulator(0.0)
+    big = C.accumulator(-1, 'max')
+    hist = C.accumulator(np.zeros(4, dtype=int))
+    seen = C.accumulator([], lambda a,b: a+b)
+
+    def keep(e):
+        total.add(e)
+        big.add(e)
+        hist.local[e%4] += 1
+        seen.add([e])
+        if e % 3 == 0:
+            dropped.add(1)
+            return False
+        return True
+
+    dfm = C.iterates(N).filter(keep)
+    assert dropped.value == 0 # not merged until an action
+    n = dfm.len()
+    assert dropped.value == (N+2)//3
+    assert n + dropped.value == N
+    assert isinstance(total.value, float)
+    assert total.value == N*(N-1)//2
+    assert big.value == N-1
+    assert hist.value.sum() == N and hist.value[1] == N//4
+    assert sorted(seen.value) == list(range(N))
+    assert dropped.local == 0
+
+    # accumulates across actions
+    dfm.filter(keep).len()
+    assert dropped.value == (N+2)//3 # nothing else dropped
+    assert hist.value.sum() == N + n
+
+    for acc in [dropped, total, big, hist, seen]:
+        acc.free()
+    assert C.accumulators == []
+    with C.accumulator(0) as cnt:
+        C.iterates(N).map(lambda x: cnt.add(1)).len()
+        assert cnt.value == N
+    assert C.accumulators == []
+
 def test_combinations():
     test_dfm(0)
     test_dfm(1)
@@ -119,12 +414,26 @@ def test_combinations():
     test_reduce(1)
     test_reduce(16)
 
+    test_take(0)
+    test_take(7)
+    test_sample(0)
+    test_sample(3)
+    test_topk(1)
+    test_topk(2)
+
+    test_aggregate(0)
+    test_aggregate(3)
+
     test_filter(0)
     test_filter(1)
     test_filter(21)
     test_filter(311)
 
     test_flatmap()
+    test_map_dynamic(0)
+    test_map_dynamic(5)
+    test_rebalance(0)
+    test_rebalance(7)
     test_nodemap(100)
 
 if __name__=="__main__":
@@ -1,6 +1,7 @@
 import pytest
 
 from mpi_list.dfm import DFM, Context
+from mpi_list.gather import gather_partitions, sparse_exchange
 
 __author__ = "David M. Rogers"
 __copyright__ = "Oak Ridge National Lab"
@@ -64,6 +65,123 @@ def test_repartition(N=0, M=1):
     for e in dfm.E:
         assert len(e) >= N//M
 
+def test_plan(N=23, M=7):
+    C = Context()
+    split = lambda df,rng: [df[r0:r1] for r0,r1 in rng]
+
+    start = C.iterates(N)
+    expect = None
+    for it in range(5):
+        # same layout every time, but new values
+        # (and new column counts on iteration 2)
+        w = 5 if it == 2 else 4
+        dfm = start.map( lambda x: np.full((x,w), x+it) ) \
+                   .repartition(len, split, np.vstack, M)
+        assert len(C.plans) == 1
+        ans = dfm.collect(None)
+        ref = np.vstack([np.full((x,w), x+it) for x in range(N)])
+        assert np.array_equal(np.vstack(ans), ref)
+        if expect is None:
+            expect = [len(e) for e in ans]
+        assert [len(e) for e in ans] == expect
+
+    P = next(iter(C.plans.values()))
+    assert P.runs == 5 and P.shapes is not None
+    if len(P.sends) + len(P.recvs) > 0: # last run used persistent requests
+        assert P.reqs is not None
+    # plans are cached by layout, and work for objects
+    lst = C.iterates(N).map(lambda x: list(range(x+1)))
+    for it in range(2):
+        out = lst.repartition(len, split, concat, M).collect(None)
+        assert concat(out) == concat(lst.collect(None))
+    assert len(C.plans) == 2
+    C.clear_plans()
+    assert len(C.plans) == 0
+
+def test_sparse_exchange():
+    C = Context()
+    # each rank sends to the next two ranks
+    dst = set( (C.rank+k) % C.procs for k in (1, 2) ) - {C.rank}
+    ans = sparse_exchange(C, { r: (C.rank, r) for r in dst })
+    src = sorted( set( (C.rank-k) % C.procs for k in (1, 2) ) - {C.rank} )
+    assert ans == [ (r, (r, C.rank)) for r in src ]
+
+    # nothing to send
+    assert sparse_exchange(C, {}) == []
+
+@pytest.mark.parametrize("sparse", [None, True, False])
+def test_gather_sparse(sparse, N=13):
+    C = Context()
+    # every rank contributes to every output index
+    dP = { i: [(C.rank, i)] for i in range(N) }
+    ans = gather_partitions(C, dP, N, sparse=sparse)
+    i0 = C.rank * (N//C.procs) + min(C.rank, N%C.procs)
+    assert len(ans) == len( range(i0, (C.rank+1) * (N//C.procs)
+                                      + min(C.rank+1, N%C.procs)) )
+    for k, grp in enumerate(ans):
+        # local contribution first, then by rank
+        order = [C.rank] + [r for r in range(C.procs) if r != C.rank]
+        assert grp == [ (r, i0+k) for r in order ]
+
+def test_sparse_rounds(rounds=50, N=7):
+    # back-to-back exchanges must not mix up their messages
+    C = Context()
+    for t in range(rounds):
+        dP = { i: [(t, C.rank, i)] for i in range(N) }
+        ans = gather_partitions(C, dP, N, sparse=True)
+        assert all(x[0] == t for grp in ans for x in grp)
+        assert all(len(grp) == C.procs for grp in ans)
+        dst = {(C.rank+1+t) % C.procs} - {C.rank}
+        got = sparse_exchange(C, { r: t for r in dst })
+        assert [x for _, x in got] == [t]*len(got)
+
+def test_group_arrays(N=37, M=6):
+    C = Context()
+    # element i holds rows [i, j] for j < i%5, with key (i+j) % M
+    def kv(i):
+        j = np.arange(i % 5)
+        return (i+j) % M, np.stack([np.full(len(j), i), j], axis=1)
+    dfm = C.iterates(N).group_arrays(kv, M)
+
+    i0 = C.rank * (M//C.procs) + min(C.rank, M%C.procs)
+    assert len(dfm.E) == len(range(i0, (C.rank+1) * (M//C.procs)
+                                       + min(C.rank+1, M%C.procs)))
+    for k, v in enumerate(dfm.E):
+        rows = [(i, j) for i in range(N) for j in range(i%5) if (i+j) % M == i0+k]
+        assert v.shape == (len(rows), 2) and v.dtype == np.int64
+        assert [tuple(r) for r in v] == rows # ordered by source
+    assert sum(len(v) for v in dfm.collect(None)) == \
+           sum(i % 5 for i in range(N))
+
+    # ranks without elements, scalar rows
+    out = C.iterates(1).group_arrays(lambda i: ([0, 1, 1], [.5, 1., 2.]), 2)
+    got = out.collect(None)
+    assert [list(x) for x in got] == [[.5], [1., 2.]]
+
+def test_group_spill(tmp_path, N=200, M=9):
+    import os, gc
+    C = Context()
+    def groups(e, out):
+        out.setdefault(e % M, []).append(str(e)*5)
+    dfm = C.iterates(N)
+    ref = dfm.group(groups, sorted, M)
+    out = dfm.group(groups, sorted, M, max_bytes=256, spill_dir=str(tmp_path))
+
+    E = out.E
+    assert len(E) == len(ref.E) and len(E.runs) > 0
+    assert list(E) == ref.E
+    if len(E) > 1:
+        assert E[1] == ref.E[1] and E[-1] == ref.E[-1]
+        assert E[1:] == ref.E[1:]
+    assert out.collect(None) == ref.collect(None)
+    assert out.map(len).reduce(lambda a,b: a+b, 0) == N
+
+    path = E.path
+    assert os.path.isdir(path)
+    del E, out
+    gc.collect()
+    assert not os.path.exists(path)
+
 def test_all():
     test_group(10, 1)
     test_group(1, 10)
@@ -0,0 +1,87 @@
+import pytest
+
+from mpi_list import Context
+from mpi_list.partition import BlockPartitioner, HashPartitioner, \
+                               IndexPartitioner, RangePartitioner
+
+__author__ = "David M. Rogers"
+__copyright__ = "Oak Ridge National Lab"
+__license__ = "MIT"
+
+def shuffles(C, fn):
+    # number of shuffles made by fn()
+    C.tracer.events = []
+    fn()
+    return sum(1 for ev in C.tracer.events
+                 if ev["name"] in ("gather_partitions", "sparse_exchange"))
+
+def test_block(N=20):
+    C = Context()
+    dfm = C.iterates(N)
+    assert dfm.part == BlockPartitioner()
+    assert dfm.map(lambda x: x+1).part == BlockPartitioner()
+    assert dfm.rebalance() is dfm
+    assert dfm.filter(lambda x: x % 2 == 0).part is None
+    assert C.iterates(N, robin=True).part is None
+
+def test_pairs(N=50):
+    C = Context()
+    C.enable_trace()
+    add = lambda a, b: a+b
+    pairs = C.iterates(N).map(lambda i: (f"k{i%7}", i))
+
+    r = pairs.reduceByKey(add)
+    assert r.part == HashPartitioner(C.procs)
+    ans = dict(r.collect(None))
+    assert ans == { f"k{j}": sum(range(j, N, 7)) for j in range(7) }
+
+    # keys are only on their owner
+    own = r.part.ranks([k for k, _ in r.E], C.procs)
+    assert all(o == C.rank for o in own)
+
+    # partitioned data is not shuffled again
+    r2 = r.map(lambda kv: (kv[0], 2*kv[1]), preservesPartitioning=True)
+    assert r2.part == r.part
+    assert r2.map(lambda kv: kv).part is None
+    assert r2.partitionBy() is r2
+    assert shuffles(C, lambda: r2.reduceByKey(add)) == 0
+    assert shuffles(C, lambda: r2.filter(lambda kv: True).groupByKey()) == 0
+    assert shuffles(C, lambda: r2.partitionBy(C.procs+1)) == 1
+
+    g = pairs.groupByKey(3)
+    assert g.part == HashPartitioner(3)
+    assert sorted(sum([v for _, v in g.collect(None)], [])) == list(range(N))
+
+    # join: only the unpartitioned side moves
+    other = C.iterates(7).map(lambda j: (f"k{j}", -j))
+    n = shuffles(C, lambda: r.join(other))
+    assert n == 1
+    J = r.join(other)
+    assert J.part == r.part
+    assert sorted(J.collect(None)) == \
+           sorted((f"k{j}", (ans[f"k{j}"], -j)) for j in range(7))
+
+def test_range(N=30):
+    C = Context()
+    part = RangePartitioner([N*(r+1)//C.procs for r in range(C.procs-1)])
+    d = C.iterates(N, robin=True).map(lambda i: (i, i)).partitionBy(part)
+    assert d.part == part
+    lo = 0 if C.rank == 0 else part.splitters[C.rank-1]
+    hi = N if C.rank == C.procs-1 else part.splitters[C.rank]
+    assert sorted(k for k, _ in d.E) == list(range(lo, hi))
+
+def test_regroup(N=40, M=6):
+    C = Context()
+    C.enable_trace()
+    def by_mod(e, out):
+        for x in (e if isinstance(e, list) else [e]):
+            out.setdefault(x % M, []).append(x)
+    g = C.iterates(N).group(by_mod, lambda x: x, M)
+    assert g.part == IndexPartitioner(M)
+
+    h = []
+    assert shuffles(C, lambda: h.append(g.group(by_mod, sorted, M))) == 0
+    assert h[0].part == IndexPartitioner(M)
+    assert sorted(sum(h[0].collect(None), [])) == list(range(N))
+    # a different grouping still communicates
+    assert shuffles(C, lambda: g.group(by_mod, sorted, M+1)) == 1
@@ -2,7 +2,7 @@ import pytest
 
 import numpy as np
 from mpi_list import Context
-from mpi_list.reducer import Reducer, CommReducer
+from mpi_list.reducer import Reducer, CommReducer, HierReducer
 
 __author__ = "David M. Rogers"
 __copyright__ = "Oak Ridge National Lab"
@@ -35,7 +35,33 @@ def test2():
     if C.rank == 0:
         print(x0[0])
 
+def test_hier():
+    C = Context()
+
+    def add(x,y):
+        x += y
+        return x
+    for x0 in [np.zeros((3,4)), 0]:
+        R = Reducer(add, x0 + C.rank)
+        ans = HierReducer(C,R)()
+        if C.rank == 0:
+            assert np.all(ans == C.procs*(C.procs-1)//2)
+
+    # object arrays can't go through shared memory
+    x0 = np.array([C.rank, None], dtype=object)
+    R = Reducer(lambda a,b: np.array([a[0]+b[0], None], dtype=object), x0)
+    ans = HierReducer(C,R)()
+    if C.rank == 0:
+        assert ans[0] == C.procs*(C.procs-1)//2
+
+    # ordered (non-commutative) reduction
+    R = Reducer(lambda a,b: a+b, [C.rank])
+    ans = HierReducer(C,R)()
+    if C.rank == 0:
+        assert ans == list(range(C.procs))
+
 if __name__=="__main__":
     "Allow tests to be run stand-alone using mpirun."
     test()
     test2()
+    test_hier()
@@ -0,0 +1,72 @@
+import pytest
+
+import numpy as np
+from mpi_list import Context
+from mpi_list.serial import compressor
+from mpi_list.gather import gather_partitions
+
+__author__ = "David M. Rogers"
+__copyright__ = "Oak Ridge National Lab"
+__license__ = "MIT"
+
+serializers = ["pkl5", "pickle", "zlib", "auto"]
+
+@pytest.mark.parametrize("ser", serializers)
+def test_ops(ser, N=37):
+    C = Context(serializer=ser)
+
+    dfm = C.iterates(N).map(lambda x: {'x': np.arange(x)})
+    ans = dfm.collect(root=None)
+    assert len(ans) == N and len(ans[-1]['x']) == N-1
+
+    s = dfm.map(lambda e: e['x'].sum()).scan(lambda a,b: a+b).collect()
+    if C.rank == 0:
+        assert s[-1] == sum(i*(i-1)//2 for i in range(N))
+
+    h = dfm.head(3)
+    assert [len(e['x']) for e in h] == [0, 1, 2]
+
+    rep = dfm.map(lambda e: e['x']).repartition(len,
+                    lambda a,rng: [a[r0:r1] for r0,r1 in rng],
+                    np.concatenate, 5)
+    assert rep.map(len).reduce(lambda a,b: a+b, 0) == N*(N-1)//2
+
+    def groups(e, out):
+        out.setdefault(len(e['x']) % 4, []).append(e)
+    grp = dfm.group(groups, lambda x: x, 4)
+    assert grp.map(len).reduce(lambda a,b: a+b, 0) == N
+    for sparse in [True, False]:
+        out = gather_partitions(C, {(C.rank+1) % C.procs: [C.rank]},
+                                C.procs, sparse=sparse)
+        assert out == [[(C.rank-1) % C.procs]]
+
+    bal = dfm.filter(lambda e: len(e['x']) < 5).rebalance()
+    assert bal.len() == 5
+
+    dyn = dfm.map_dynamic(lambda e: len(e['x']))
+    assert dyn.E == [len(e['x']) for e in dfm.E]
+
+@pytest.mark.parametrize("ser", serializers)
+def test_comm(ser):
+    C = Context(serializer=ser)
+    comm = C.comm
+
+    x = comm.scatter([[i]*3 for i in range(C.procs)]
+                         if C.rank == 0 else None, root=0)
+    assert x == [C.rank]*3
+
+    nxt = (C.rank+1) % C.procs
+    prv = (C.rank-1) % C.procs
+    y = comm.sendrecv({'r': C.rank}, dest=nxt, source=prv)
+    assert y == {'r': prv}
+
+    req = comm.isend(np.ones(5)*C.rank, dest=nxt, tag=3)
+    msg = comm.mprobe(source=prv, tag=3)
+    assert np.all(msg.recv() == prv)
+    req.wait()
+
+    assert comm.alltoall(list(range(C.procs))) == [C.rank]*C.procs
+
+def test_compressor():
+    comp, decomp = compressor("zlib")
+    assert decomp(comp(b"abc"*100)) == b"abc"*100
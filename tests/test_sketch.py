@@ -0,0 +1,58 @@
+import pytest
+
+from mpi_list import Context
+from mpi_list.sketch import hash64, stable_hash, HyperLogLog, QuantileSketch, CountMin
+
+__author__ = "David M. Rogers"
+__copyright__ = "Oak Ridge National Lab"
+__license__ = "MIT"
+
+import numpy as np
+
+def test_hash():
+    C = Context()
+    x = ["a", "bc", (1, 2), 3.5]
+    h = hash64(x)
+    assert h.dtype == np.uint64 and len(h) == 4
+    # same values on every rank
+    assert all((g == h).all() for g in C.comm.allgather(h))
+    assert stable_hash("a") == int(h[0])
+    assert (hash64(np.arange(5)) == hash64(list(range(5)))).all()
+    assert hash64([0.0])[0] == hash64([-0.0])[0]
+    # numbers hash the same in mixed lists
+    assert (hash64([1, 2.5, "x"])[:2] == [hash64([1])[0], hash64([2.5])[0]]).all()
+    assert hash64([2**64-1])[0] == hash64([-1])[0]
+    assert (hash64([1,2], seed=1) != hash64([1,2])).all()
+
+def test_local():
+    x = np.arange(100000) % 5000
+    H = HyperLogLog(12).update(x[:50000])
+    H.merge(HyperLogLog(12).update(x[50000:]))
+    assert abs(H.count() - 5000) < 0.1*5000
+    assert HyperLogLog(12).count() == 0
+
+    Q = QuantileSketch(k=100, seed=1).update(np.arange(10001))
+    assert Q.n == 10001
+    assert abs(Q.quantile(0.5) - 5000) < 500
+    assert np.isnan(QuantileSketch().quantile(0.5))
+
+    S = CountMin(width=512, depth=4).update(x % 10)
+    assert (S.estimate([0, 3]) >= 10000).all()
+    assert S.estimate(["x"])[0] == 0
+
+def test_dfm(N=1000):
+    C = Context()
+    dfm = C.iterates(N)
+
+    n = dfm.approxCountDistinct(p=12, key=lambda i: i % 300)
+    assert abs(n - 300) < 30
+    n = dfm.map(lambda i: np.arange(i, i+10)).approxCountDistinct(p=12)
+    assert abs(n - (N+9)) < 0.1*N
+
+    q = dfm.approxQuantile([0.1, 0.5, 0.9], k=64)
+    assert np.allclose(q, [0.1*N, 0.5*N, 0.9*N], atol=0.05*N)
+
+    S = dfm.sketch(CountMin(256, 3), key=lambda i: f"k{i%7}")
+    cnt = S.estimate([f"k{i}" for i in range(7)])
+    assert (cnt >= N//7).all()
+    assert S.table[0].sum() == N
@@ -0,0 +1,58 @@
+import pytest
+
+from mpi_list import Context
+
+__author__ = "David M. Rogers"
+__copyright__ = "Oak Ridge National Lab"
+__license__ = "MIT"
+
+def source(C, nb, bs=5):
+    # rank r produces nb+r batches of bs ints
+    for b in range(nb + C.rank):
+        yield [ (b*C.procs + C.rank)*bs + i for i in range(bs) ]
+
+@pytest.mark.parametrize("prefetch", [True, False])
+def test_stream(prefetch, nb=4):
+    C = Context()
+    S = C.stream(source(C, nb), prefetch=prefetch) \
+         .map(lambda x: 2*x) \
+         .filter(lambda x: x % 3 != 0)
+    lens = [d.len() for d in S]
+    assert len(lens) == nb + C.procs - 1
+    assert all(n > 0 for n in lens)
+
+    expect = sum(1 for r in range(C.procs)
+                   for b in range(nb + r)
+                   for i in range(5) if (2*((b*C.procs + r)*5 + i)) % 3 != 0)
+    assert sum(lens) == expect
+
+def test_close_early(nb=4):
+    # stopping before the source is exhausted
+    # leaves a prefetch pending, which is cancelled
+    C = Context()
+    it = iter(C.stream(source(C, nb)))
+    assert next(it).len() == 5*C.procs
+    it.close()
+
+def test_reduce_by_key(nb=3):
+    C = Context()
+    nbatch = nb + C.procs - 1
+    S = C.stream(source(C, nb)).map(lambda x: (f"k{x%4}", 1))
+    for k, d in enumerate(S.reduceByKey(lambda a,b: a+b)):
+        counts = dict(d.collect(None))
+    assert sorted(counts) == ["k0", "k1", "k2", "k3"]
+    assert sum(counts.values()) == 5*sum(nb + r for r in range(C.procs))
+
+    # each key is owned by exactly one rank
+    S = C.stream(source(C, nb)).map(lambda x: (x % 4, x))
+    for k, d in enumerate(S.reduceByKey(lambda a,b: a+b, window=1)):
+        keys = [x for x, _ in d.E]
+        assert len(keys) == len(set(keys))
+        allkeys = sum(C.comm.allgather(keys), [])
+        assert len(allkeys) == len(set(allkeys))
+        if k == nbatch-1: # only the last rank has a batch left
+            tot = sum(v for _, v in d.collect(None))
+            r = C.procs-1
+            b = nb + r - 1
+            assert tot == sum((b*C.procs + r)*5 + i for i in range(5))
+    assert k == nbatch-1
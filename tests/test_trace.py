@@ -0,0 +1,59 @@
+import pytest
+import json
+
+from mpi_list import Context
+
+__author__ = "David M. Rogers"
+__copyright__ = "Oak Ridge National Lab"
+__license__ = "MIT"
+
+import numpy as np
+
+def test_trace(tmp_path, N=50):
+    C = Context()
+    C.enable_trace()
+
+    dfm = C.iterates(N).map(lambda x: [x]*3)
+    dfm.reduce(lambda a,b: a+b, [])
+    dfm.map(lambda x: np.ones(4)).reduce(lambda a,b: a+b, np.zeros(4))
+    dfm.collect()
+    dfm.scan(lambda a,b: a+b)
+    dfm.collect(None)
+
+    fname = tmp_path / "trace.json"
+    summ = C.write_trace(fname)
+    assert summ["map"]["count"] == 2
+    assert summ["collect"]["count"] == 2
+    if C.procs > 1:
+        assert summ["reduce"]["comm"] > 0.0
+        moved = summ["reduce_send"]["bytes_sent"] if C.rank > 0 \
+                    else summ["reduce_recv"]["bytes_recv"]
+        assert moved > 0
+        # neighbour exchange of the scan
+        scan = summ["scan_exchange"]
+        if C.rank < C.procs-1:
+            assert scan["bytes_sent"] > 0
+        if C.rank > 0:
+            assert scan["bytes_recv"] > 0
+        # collect() moves data to root, collect(None) everywhere
+        gath = summ["collect_gather"]
+        assert gath["bytes_recv"] > 0
+        assert gath["bytes_sent"] > 0
+
+    if C.rank == 0:
+        with open(fname) as f:
+            ev = json.load(f)["traceEvents"]
+        names = set(e["name"] for e in ev)
+        assert "map" in names and "reduce" in names
+        pids = set(e["pid"] for e in ev)
+        assert pids == set(range(C.procs))
+        maps = [e for e in ev if e["name"] == "map" and e["pid"] == 0]
+        assert maps[0]["args"]["n_in"] == maps[0]["args"]["n_out"]
+
+def test_untraced(tmp_path):
+    C = Context()
+    with C.span("x") as info:
+        info["y"] = 1
+    assert C.tracer is None
+    with pytest.raises(RuntimeError):
+        C.write_trace(tmp_path / "trace.json")
@@ -0,0 +1,57 @@
+import pytest
+import os
+
+from mpi_list import Context
+from mpi_list import tune
+
+__author__ = "David M. Rogers"
+__copyright__ = "Oak Ridge National Lab"
+__license__ = "MIT"
+
+import numpy as np
+
+def test_derive():
+    lat, bw = 1e-6, 1e10
+    times = {}
+    for n in tune.SIZES:
+        t = lat + n/bw + (4*lat if n > 32768 else 0) # rendezvous
+        times[n] = (t, 0.5*t if n < 4096 else 2*t)
+    P = tune.derive(times)
+    assert P.latency == pytest.approx(lat, rel=1e-2)
+    assert P.eager == 32768
+    assert P.pickle_max == 1024
+    assert (1 << 22) <= P.chunk <= (1 << 30)
+    assert P.max_elems >= 1000
+
+def test_autotune(tmp_path):
+    C = Context()
+    path = C.comm.bcast(str(tmp_path / "tune.json"))
+    old = tune.params
+    try:
+        P = C.autotune(path)
+        assert C.comm.allgather(P.asdict()) == [P.asdict()]*C.procs
+        assert tune.params is P
+        if C.procs > 1:
+            assert P.latency > 0 and P.bandwidth > 0
+            if C.rank == 0:
+                assert os.path.exists(path)
+            # second call reads the cache
+            assert C.autotune(path).asdict() == P.asdict()
+    finally:
+        tune.params = old
+
+def test_small_chunks(N=5000):
+    # chunked transfers give the same answers with tiny messages
+    C = Context()
+    old = tune.params
+    tune.params = tune.Params(chunk=1000, max_elems=7)
+    try:
+        x = C.iterates(C.procs).map(lambda i: np.full(N, i+1.0))
+        s = x.reduce(lambda a, b: a+b, np.zeros(N))
+        assert (s == C.procs*(C.procs+1)/2).all()
+
+        tbl = C.broadcast(np.arange(N) if C.rank == 0 else None)
+        assert (tbl.value == np.arange(N)).all()
+        tbl.free()
+    finally:
+        tune.params = old